@@ -0,0 +1,404 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import zipfile
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; peak RSS is then not reported
+    resource = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO_ROOT, "codes"), os.path.join(REPO_ROOT, "eclectic")]
+
+FINDINGS_ZIP = os.path.join(REPO_ROOT, "eclectic", "findings.zip")
+DETAILED_SOURCE = os.path.join(REPO_ROOT, "eclectic", "gemini1.5flash.zip") + ":detailed_findings"
+KEYWORDS_SOURCE = os.path.join(REPO_ROOT, "eclectic", "gemini1.5flash.zip") + ":keywords"
+XML_TEMPLATE = ('<?xml version="1.0" encoding="utf-8"?><eCitation><meta type="rr"/><uId id="{id}"/>'
+                '<MedlineCitation><Article><Abstract><AbstractText Label="COMPARISON">None.</AbstractText>'
+                '<AbstractText Label="FINDINGS">{findings}</AbstractText><AbstractText Label="IMPRESSION">'
+                'No acute disease.</AbstractText></Abstract></Article></MedlineCitation></eCitation>')
+
+# Error raised by a stage whose optional dependencies are not installed
+class StageSkipped(Exception):
+    pass
+
+# Function to import cpir-mr.py, whose file name is not a valid module name
+def load_cpir_mr():
+    spec = importlib.util.spec_from_file_location("cpir_mr", os.path.join(REPO_ROOT, "codes", "cpir-mr.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Function to import a module needed by a stage, skipping the stage when it is missing
+def require(module_name):
+    try:
+        return __import__(module_name)
+    except ImportError as e:
+        raise StageSkipped(f"{module_name} is not installed ({e})")
+
+# Function to sample report texts from findings.zip, repeating the sample to reach count reports.
+# Returns (name, text, source name in findings.zip) triples; repeated reports get a new name.
+def sample_reports(count, seed=0):
+    from corpus import Corpus
+
+    with Corpus(FINDINGS_ZIP) as corpus:
+        names = corpus.names()
+        picked = random.Random(seed).sample(names, min(count, len(names)))
+        texts = {name: corpus.read(name) for name in picked}
+    reports = []
+    for i in range(count):
+        name = picked[i % len(picked)]
+        reports.append((name if i < len(picked) else f"{os.path.splitext(name)[0]}_{i}.txt", texts[name], name))
+    return reports
+
+# Function to build the benchmark fixtures: sampled findings and a synthetic ecgen-radiology zip
+def build_fixtures(folder, count, seed=0):
+    reports = sample_reports(count, seed)
+    reports_path = os.path.join(folder, "reports.json")
+    with open(reports_path, "w", encoding="utf-8") as f:
+        json.dump(reports, f)
+
+    from xml.sax.saxutils import escape
+
+    xml_zip = os.path.join(folder, "ecgen-radiology.zip")
+    with zipfile.ZipFile(xml_zip, "w", zipfile.ZIP_DEFLATED) as archive:
+        for i, (name, text, _) in enumerate(reports):
+            report_id = os.path.splitext(name)[0]
+            archive.writestr(f"ecgen-radiology/{i}.xml", XML_TEMPLATE.format(id=report_id, findings=escape(text)))
+    return {"reports": reports_path, "xml_zip": xml_zip, "count": count, "seed": seed}
+
+def load_reports(fixtures):
+    with open(fixtures["reports"], "r", encoding="utf-8") as f:
+        return [tuple(report) for report in json.load(f)]
+
+# Function to time fn over each item; returns the per-call latencies in seconds
+def time_calls(fn, items):
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+# Stage: extract uId and FINDINGS from XML, one report at a time in this process
+def bench_xml_extract(fixtures, options):
+    import xml2txt
+
+    items = list(xml2txt.iter_xml_sources(fixtures["xml_zip"]))
+    latencies = time_calls(xml2txt.parse_xml_source, items)
+    return {"items": len(items), "seconds": sum(latencies), "latencies": latencies}
+
+# Stage: read and extract the XML archive across the process pool
+def bench_xml_extract_pool(fixtures, options):
+    import xml2txt
+
+    start = time.perf_counter()
+    items = sum(1 for _ in xml2txt.iter_findings(fixtures["xml_zip"], workers=options["workers"]))
+    return {"items": items, "seconds": time.perf_counter() - start, "latencies": None}
+
+# Stage: plan token-budgeted batches and build both prompts of every batch
+def bench_prompt_build(fixtures, options):
+    cpir_mr = load_cpir_mr()
+    from batch_planner import plan_batches
+
+    reports = load_reports(fixtures)
+    texts = {name: text for name, text, _ in reports}
+    start = time.perf_counter()
+    batches = plan_batches(list(texts), list(texts.values()),
+                           cpir_mr.PROMPT_TOKEN_BUDGET, cpir_mr.RESPONSE_TOKEN_BUDGET, cpir_mr.MAX_BATCH_SIZE)
+    planning = time.perf_counter() - start
+
+    def build(batch):
+        batch_texts = [texts[name] for name in batch]
+        cpir_mr.generate_prompt(batch_texts)
+        cpir_mr.generate_analysis_prompt(batch_texts, batch_texts)
+
+    if batches:
+        build(batches[0])  # Warm up
+    latencies = time_calls(build, batches)
+    return {"items": len(reports), "seconds": planning + sum(latencies), "latencies": latencies}
+
+# Stage: parse streamed CPIR-MR and CPMK-E responses of the fake backend
+def bench_section_parse(fixtures, options):
+    cpir_mr = load_cpir_mr()
+    from batch_planner import plan_batches
+    from llm_backend import FakeBackend, TextChunk
+    from response_parser import parse_detailed_sections, parse_pair_sections
+
+    reports = load_reports(fixtures)
+    texts = {name: text for name, text, _ in reports}
+    batches = plan_batches(list(texts), list(texts.values()),
+                           cpir_mr.PROMPT_TOKEN_BUDGET, cpir_mr.RESPONSE_TOKEN_BUDGET, cpir_mr.MAX_BATCH_SIZE)
+    backend = FakeBackend(latency=0, seed=options["seed"])
+    responses = []
+    for batch in batches:
+        batch_texts = [texts[name] for name in batch]
+        detailed = [TextChunk(text) for text in backend.stream(cpir_mr.generate_prompt(batch_texts))]
+        analysis = [TextChunk(text) for text in backend.stream(cpir_mr.generate_analysis_prompt(batch_texts, batch_texts))]
+        responses.append((len(batch), detailed, analysis))
+
+    def parse(response):
+        count, detailed, analysis = response
+        parse_detailed_sections(detailed, count)
+        parse_pair_sections(analysis, count)
+
+    latencies = time_calls(parse, responses)
+    return {"items": len(reports), "seconds": sum(latencies), "latencies": latencies}
+
+# Stage: the full CPIR-MR + CPMK-E dispatcher against the fake backend
+def bench_llm_pipeline(fixtures, options):
+    cpir_mr = load_cpir_mr()
+    from batch_planner import plan_batches
+    from llm_backend import FakeBackend
+
+    reports = load_reports(fixtures)
+    texts = {name: text for name, text, _ in reports}
+
+    # Serve the sampled reports the way the corpus reader does
+    class ReportCorpus:
+        def read(self, name):
+            return texts[name]
+
+    batches = plan_batches(list(texts), list(texts.values()),
+                           cpir_mr.PROMPT_TOKEN_BUDGET, cpir_mr.RESPONSE_TOKEN_BUDGET, cpir_mr.MAX_BATCH_SIZE)
+    backend = FakeBackend(latency=options["fake_latency"], seed=options["seed"])
+    start = time.perf_counter()
+    for _, result in cpir_mr.process_batches(backend, ReportCorpus(), batches, options["concurrency"]):
+        if isinstance(result, Exception):
+            raise result
+    seconds = time.perf_counter() - start
+    return {"items": len(reports), "seconds": seconds, "latencies": list(backend.latencies)}
+
+# Function to import MTD_dc.py, skipping the stage when the vision dependencies are missing
+def load_mtd():
+    for module_name in ("torch", "transformers", "torchxrayvision", "skimage", "torchvision"):
+        require(module_name)
+    import MTD_dc
+
+    return MTD_dc
+
+# Stage: BLIP vision embedding of 384px images with a small random-weight model
+def bench_blip_embed(fixtures, options):
+    MTD_dc = load_mtd()
+    import torch
+    from transformers import BlipConfig, BlipModel
+
+    torch.manual_seed(options["seed"])
+    config = BlipConfig(
+        vision_config={"hidden_size": 128, "intermediate_size": 256, "num_hidden_layers": 2, "num_attention_heads": 4},
+        text_config={"hidden_size": 128, "intermediate_size": 256, "num_hidden_layers": 1, "num_attention_heads": 4},
+        projection_dim=512,
+    )
+    # The engine normally loads its processor and weights from the hub; only the model is needed here
+    engine = MTD_dc.BlipEmbeddingEngine.__new__(MTD_dc.BlipEmbeddingEngine)
+    engine.device = torch.device("cpu")
+    engine.batch_size = options["image_batch_size"]
+    engine.dtype = torch.float32
+    engine.reduction = "projection"
+    engine.model = BlipModel(config).eval()
+
+    pixel_values = torch.randn(options["images"], 3, 384, 384)
+    batches = [pixel_values[start:start + engine.batch_size] for start in range(0, len(pixel_values), engine.batch_size)]
+    engine.embed_pixels(batches[0])  # Warm up
+    latencies = time_calls(engine.embed_pixels, batches)
+    return {"items": len(pixel_values), "seconds": sum(latencies), "latencies": latencies}
+
+# Function to time the reduction of random 24x24 BLIP patch grids (with CLS token) to 128 dimensions
+def time_reduction(options, method):
+    MTD_dc = load_mtd()
+    import torch
+
+    torch.manual_seed(options["seed"])
+    image_embeds = torch.randn(options["images"], 577, 768)
+    batches = [image_embeds[start:start + options["image_batch_size"]] for start in range(0, len(image_embeds), options["image_batch_size"])]
+    MTD_dc.reduce_image_embeds(batches[0], method)  # Warm up (and build the cached projection)
+    latencies = time_calls(lambda batch: MTD_dc.reduce_image_embeds(batch, method), batches)
+    return {"items": len(image_embeds), "seconds": sum(latencies), "latencies": latencies}
+
+# Stage: embedding reduction with the precomputed patch weights and projection
+def bench_embed_reduce(fixtures, options):
+    return time_reduction(options, "projection")
+
+# Stage: embedding reduction through the original 128x128 bilinear upsampling
+def bench_embed_reduce_legacy(fixtures, options):
+    return time_reduction(options, "interpolate")
+
+# Stage: XRayVision DenseNet classification of 224px images with random weights
+def bench_xray_classify(fixtures, options):
+    MTD_dc = load_mtd()
+    import torch
+    import torchxrayvision as xrv
+
+    torch.manual_seed(options["seed"])
+    classifier = MTD_dc.XRayClassifier(torch.device("cpu"), batch_size=options["image_batch_size"])
+    classifier.model = xrv.models.DenseNet(weights=None).eval()
+    # Random-weight models define no pathology names on every torchxrayvision release
+    classifier.model.pathologies = xrv.datasets.default_pathologies
+
+    images = torch.randn(options["images"], 1, 224, 224)
+    batches = [images[start:start + classifier.batch_size] for start in range(0, len(images), classifier.batch_size)]
+    classifier.classify(batches[0])  # Warm up
+    latencies = time_calls(classifier.classify, batches)
+    return {"items": len(images), "seconds": sum(latencies), "latencies": latencies}
+
+# Stage: plotting metrics (readability, sentiment, corpus TF-IDF) over the sampled reports
+def bench_metrics(fixtures, options):
+    require("textstat")
+    require("textblob")
+    import metrics
+    from corpus import Corpus
+
+    reports = load_reports(fixtures)
+    with Corpus(DETAILED_SOURCE) as detailed_corpus, Corpus(KEYWORDS_SOURCE) as keywords_corpus:
+        rows = [(name, text, detailed_corpus.read(source), keywords_corpus.read(source)) for name, text, source in reports]
+    rows = [row for row in rows if row[2] is not None and row[3] is not None]
+    start = time.perf_counter()
+    metrics.compute_metrics(*map(list, zip(*rows)), workers=options["workers"])
+    return {"items": len(rows), "seconds": time.perf_counter() - start, "latencies": None}
+
+STAGES = {
+    "xml_extract": bench_xml_extract,
+    "xml_extract_pool": bench_xml_extract_pool,
+    "prompt_build": bench_prompt_build,
+    "section_parse": bench_section_parse,
+    "llm_pipeline": bench_llm_pipeline,
+    "blip_embed": bench_blip_embed,
+    "embed_reduce": bench_embed_reduce,
+    "embed_reduce_legacy": bench_embed_reduce_legacy,
+    "xray_classify": bench_xray_classify,
+    "metrics": bench_metrics,
+}
+
+# Function to compute a latency percentile in milliseconds
+def percentile_ms(latencies, p):
+    ordered = sorted(latencies)
+    return 1000 * ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+# Function run in a fresh process per stage, so peak RSS belongs to that stage alone
+def run_stage(name, fixtures, options):
+    try:
+        measured = STAGES[name](fixtures, options)
+    except StageSkipped as e:
+        return {"skipped": str(e)}
+
+    result = {
+        "items": measured["items"],
+        "seconds": measured["seconds"],
+        "items_per_sec": measured["items"] / measured["seconds"] if measured["seconds"] else None,
+        "p50_ms": None,
+        "p95_ms": None,
+        "peak_rss_mb": None,
+    }
+    if measured["latencies"]:
+        result["p50_ms"] = percentile_ms(measured["latencies"], 50)
+        result["p95_ms"] = percentile_ms(measured["latencies"], 95)
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux and bytes on macOS; pool workers count as children
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        result["peak_rss_mb"] = peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return result
+
+# Function to flag stages that got slower or bigger than the baseline by more than tolerance
+def compare_to_baseline(results, baseline, tolerance):
+    regressions = []
+    for name, result in results["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if not before or any(key in stage for key in ("skipped", "error") for stage in (result, before)):
+            continue
+        if before.get("items_per_sec") and result["items_per_sec"] < before["items_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['items_per_sec']:.1f} items/s vs {before['items_per_sec']:.1f} baseline")
+        for key, unit in (("p95_ms", "ms p95"), ("peak_rss_mb", "MB peak RSS")):
+            if before.get(key) and result.get(key) and result[key] > before[key] * (1 + tolerance):
+                regressions.append(f"{name}: {result[key]:.1f} {unit} vs {before[key]:.1f} baseline")
+    return regressions
+
+# Function to print the results as a table
+def print_results(results):
+    # The stage column fits the longest stage name plus a space
+    width = max([len("stage")] + [len(name) for name in results["stages"]]) + 1
+    print(f"{'stage':<{width}}{'items':>8}{'items/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'peak MB':>10}")
+    for name, result in results["stages"].items():
+        if "skipped" in result or "error" in result:
+            status = "skipped" if "skipped" in result else "error"
+            print(f"{name:<{width}}{status}: {result[status]}")
+            continue
+        cells = [result["items_per_sec"], result["p50_ms"], result["p95_ms"], result["peak_rss_mb"]]
+        widths = [12, 10, 10, 10]
+        print(f"{name:<{width}}{result['items']:>8}" + "".join(f"{'-' if v is None else f'{v:.1f}':>{w}}" for v, w in zip(cells, widths)))
+
+# Function to parse command-line options
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline CPU benchmarks for every stage of the CPIR-MR / MTD pipeline.")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES), help="Stages to run (default: all)")
+    parser.add_argument("--reports", type=int, default=1000, help="Reports sampled from findings.zip (repeated beyond 3,424)")
+    parser.add_argument("--images", type=int, default=64, help="Random images for the vision stages")
+    parser.add_argument("--image-batch-size", type=int, default=16, help="Images per forward pass")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes for the pooled stages (default: CPU count)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Model calls in flight for llm_pipeline")
+    parser.add_argument("--fake-latency", type=float, default=0.05, help="Mean seconds per fake LLM call")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the sampled fixtures, fake LLM and random weights")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the results as JSON")
+    parser.add_argument("--baseline", default=None, help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown or growth before flagging a regression")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {"workers": args.workers, "concurrency": args.concurrency, "fake_latency": args.fake_latency,
+               "seed": args.seed, "images": args.images, "image_batch_size": args.image_batch_size}
+
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "options": {**options, "reports": args.reports},
+        },
+        "stages": {},
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        fixtures = build_fixtures(folder, args.reports, args.seed)
+        for name in args.stages:
+            # A fresh interpreter per stage keeps imports and peak memory of other stages out of the numbers
+            # A failing stage is recorded as an error so the other stages still run and report
+            try:
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    results["stages"][name] = executor.submit(run_stage, name, fixtures, options).result()
+                print(f"{name}: done", file=sys.stderr)
+            except Exception as e:
+                results["stages"][name] = {"error": f"{type(e).__name__}: {e}"}
+                print(f"{name}: failed ({type(e).__name__}: {e})", file=sys.stderr)
+
+    print_results(results)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    failed = [name for name, result in results["stages"].items() if "error" in result]
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    if failed:
+        sys.exit(f"Stages failed: {', '.join(failed)}")
+
+# Usage (from the repository root):
+#   python benchmarks/bench_pipeline.py --output baseline.json
+#   python benchmarks/bench_pipeline.py --baseline baseline.json
+if __name__ == "__main__":
+    main()
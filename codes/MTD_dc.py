@@ -1,92 +1,425 @@
 import os  
-import torch 
-import torch.nn.functional as F
-from PIL import Image  
-from transformers import BlipProcessor, BlipModel  # BLIP image-captioning processor and model
-import torchxrayvision as xrv  # For X-ray image classification
-import skimage  
-import torchvision 
+import sys
+import argparse
+import hashlib
+import numpy as np
 import csv  
+import io
+import json
+import glob
+import shutil
+from functools import lru_cache
+from image_index import ImageIndex
+from feature_store import FeatureStore, LayeredFeatureStore, content_hash, merge_stores
+from bce_format import BCECSVWriter, BCEParquetWriter, format_bce_input, merge_parquet
+
+XRAY_WEIGHTS = "densenet121-res224-all"
+REDUCTIONS = ["projection", "interpolate"]  # Embedding reductions, see reduce_image_embeds
+INSTRUCTION = "Analyze chest X-ray data. Provide:\n1. Generate a more detailed finding for normal human understanding and non-healthcare professionals.\n2. Strictly DO NOT ADVISE MEDICINES and PRACTICES."
 
 # Main function to find matching files and process images and texts
-def find_matching_files_and_process(txt_folder, img_folder1, img_folder2, output_csv):
+def find_matching_files_and_process(txt_folder, img_folder1, img_folder2, output_csv, batch_size=16, precision="fp32", num_workers=4, index_path=None,
+                                    feature_store_dir=None, compact_feature_store=False, shard=None,
+                                    output_format="csv", embedding_dtype="float32", reduction="projection"):
+    import torch
+    import torchxrayvision as xrv
+    from torch.utils.data import DataLoader
+
     # Determine if a GPU is available, otherwise fallback to CPU
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
 
     try:
-        # Initialize the BLIP model and processor for image captioning
-        processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-        model = BlipModel.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
+        # Initialize the batched BLIP image-embedding engine (vision encoder only, loaded on first use)
+        blip_engine = BlipEmbeddingEngine(device, batch_size=batch_size, precision=precision, reduction=reduction)
+
+        # Initialize the batched XRayVision DenseNet classifier (loaded on first use)
+        xray_classifier = XRayClassifier(device, batch_size=batch_size)
 
-        # Initialize the XRayVision DenseNet model for X-ray classification
-        xray_model = xrv.models.DenseNet(weights="densenet121-res224-all").to(device)
+        # Open the feature stores holding embeddings and classifications computed by earlier runs
+        if feature_store_dir is None:
+            feature_store_dir = default_feature_store_dir(output_csv)
+        embedding_store = open_feature_store(feature_store_dir, "blip", blip_engine.model_id, 128, shard)
+        xray_store = open_feature_store(feature_store_dir, "densenet", XRAY_WEIGHTS, len(xrv.datasets.default_pathologies), shard)
 
         # Get all text (.txt) files in the provided text folder
         txt_files = [f for f in os.listdir(txt_folder) if f.endswith('.txt')]
 
+        # Pair every report with its frontal and lateral images using a persistent filename index
+        if index_path is None:
+            index_path = os.path.splitext(output_csv)[0] + "_image_index.json"
+        image_index = ImageIndex([img_folder1, img_folder2], index_path)
+        reports, unmatched_reports, unmatched_images = image_index.match_reports(txt_files, img_folder1, img_folder2)
+        print(f"Matched {len(reports)} reports; {len(unmatched_reports)} reports and {len(unmatched_images)} images unmatched.")
+
+        # Record what could not be paired next to the output CSV (once, by the first shard)
+        if not shard or shard[0] == 0:
+            with open(os.path.splitext(output_csv)[0] + "_unmatched.json", 'w', encoding='utf-8') as f:
+                json.dump({"reports": unmatched_reports, "images": unmatched_images}, f, indent=2)
+
+        # Sort by report so the output does not depend on os.listdir order, and keep this shard's reports
+        reports.sort(key=lambda report: report[0])
+        if shard:
+            reports = [report for report in reports if shard_of(report[0], shard[1]) == shard[0]]
+            output_csv = shard_output_path(output_csv, *shard, output_format)
+            print(f"Shard {shard[0]}/{shard[1]}: {len(reports)} reports -> {output_csv}")
+
         #IFT enhances LLM training, Med-PaLM
-        # Open the output CSV file for writing results
-        with open(output_csv, 'w', newline='', encoding='utf-8') as csvfile:
-            csvwriter = csv.writer(csvfile)
-            # Write the header row in the CSV
-            csvwriter.writerow(['Instruction', 'Input', 'Output'])
-
-            # Loop through each .txt file in the folder
-            for txt_file in txt_files:
-                # Extract the base name (without the .txt extension)
-                base_name = os.path.splitext(txt_file)[0]
-
-                # Look for corresponding image files with the same base name in both image folders
-                search_pattern = f"{base_name}_"
-
-                # Get matching files from both image folders
-                matching_files1 = [f for f in os.listdir(img_folder1) if f.startswith(search_pattern)]
-                matching_files2 = [f for f in os.listdir(img_folder2) if f.startswith(search_pattern)]
-
-                # If matching files are found in both folders, process the images
-                if matching_files1 and matching_files2:
+        # The output writer is opened once the pathology names are known
+        writer = None
+        pathologies = xray_store.columns or xrv.datasets.default_pathologies  # Also names the columns of an empty dataset
+        try:
+
+            # Decode every image once in worker processes, prefetching ahead of the models
+            # prefetch_factor is only accepted with worker processes on older torch releases
+            prefetch = {"prefetch_factor": 2} if num_workers > 0 else {}
+            loader = DataLoader(
+                XRayReportDataset(reports, blip_engine.processor.image_processor, xray_classifier.transform,
+                                  embedding_store.known_hashes(), xray_store.known_hashes()),
+                batch_size=batch_size,
+                num_workers=num_workers,
+                collate_fn=collate_reports,
+                **prefetch,
+            )
+
+            # Process the reports in batches so frontal and lateral images share BLIP batches
+            for batch in loader:
+                # Serve stored embeddings, and embed the remaining frontal and lateral images together
+                hashes = batch["hashes"]
+                embeddings = torch.zeros(len(hashes), 128)  # Unreadable images get a zero embedding
+                todo = []
+                for i, image_hash in enumerate(hashes):
+                    stored = embedding_store.get(image_hash) if image_hash is not None else None
+                    if stored is not None:
+                        embeddings[i] = torch.from_numpy(stored)
+                    elif batch["pixel_ok"][i]:
+                        todo.append(i)
+                if todo:
+                    embeddings[todo] = blip_engine.embed_pixels(batch["pixel_values"][todo])
+                    embedding_store.put_many([hashes[i] for i in todo], embeddings[todo].numpy())
+
+                # Serve stored pathology scores, and classify the remaining frontal images in one pass
+                frontal_hashes = hashes[0::2]
+                scores = np.zeros((len(xray_store.columns or xrv.datasets.default_pathologies), len(frontal_hashes)), dtype=np.float32)
+                classified = [False] * len(frontal_hashes)
+                todo = []
+                for k, frontal_hash in enumerate(frontal_hashes):
+                    stored = xray_store.get(frontal_hash) if frontal_hash is not None else None
+                    if stored is not None:
+                        scores[:, k] = stored
+                        classified[k] = True
+                    elif batch["xray_ok"][k]:
+                        todo.append(k)
+                if todo:
+                    scores[:, todo] = xray_classifier.classify(batch["xray"][todo])
+                    xray_store.put_many([frontal_hashes[k] for k in todo], scores[:, todo].T, columns=xray_classifier.pathologies)
+                    for k in todo:
+                        classified[k] = True
+                pathologies = xray_store.columns or xrv.datasets.default_pathologies
+
+                for k, txt_file in enumerate(batch["txt_files"]):
                     print(f"Processing matching files for: {txt_file}")
 
-                    # Use the first matching file in each folder as the target image
-                    frontal_image_path = os.path.join(img_folder1, matching_files1[0])
-                    lateral_image_path = os.path.join(img_folder2, matching_files2[0])
-
-                    # Process the frontal X-ray image with BLIP
-                    frontal_embedding = process_image(frontal_image_path, processor, model, device)
-
-                    # Process the lateral X-ray image with BLIP
-                    lateral_embedding = process_image(lateral_image_path, processor, model, device)
-
                     # Concatenate the BLIP embeddings from both images
-                    blip_embedding = torch.cat((frontal_embedding, lateral_embedding), dim=0)
-
-                    # Classify the frontal image using the XRayVision model
-                    classification_result = classify_xray(frontal_image_path, xray_model, device)
-
-                    # Create the combined input prompt using the embeddings and classification result
-                    combined_input = create_combined_prompt(blip_embedding, classification_result)
+                    blip_embedding = torch.cat((embeddings[2 * k:2 * k + 1], embeddings[2 * k + 1:2 * k + 2]), dim=0)
 
                     # Read the content of the corresponding .txt file for output
                     with open(os.path.join(txt_folder, txt_file), 'r', encoding='utf-8') as f:
                         output_content = f.read().strip()
 
-                    # Write the instruction, input, and output to the CSV file
-                    # BCE prompting to fine tune the Text decoder
-                    csvwriter.writerow([
-                        "Analyze chest X-ray data. Provide:\n1. Generate a more detailed finding for normal human understanding and non-healthcare professionals.\n2. Strictly DO NOT ADVISE MEDICINES and PRACTICES.",
-                        combined_input,
-                        output_content
-                    ])
+                    # Write the instruction, input, and output (BCE prompting to fine tune the Text decoder)
+                    if writer is None:
+                        writer = open_dataset_writer(output_csv, output_format, pathologies, bool(shard), embedding_dtype)
+                    row_embedding = blip_embedding.to(torch.float16 if embedding_dtype == "float16" else torch.float32)
+                    writer.write_row(txt_file, INSTRUCTION, row_embedding.tolist(), scores[:, k] if classified[k] else None, output_content)
+
+            # Still produce an (empty) dataset when there was nothing to write
+            if writer is None:
+                writer = open_dataset_writer(output_csv, output_format, pathologies, bool(shard), embedding_dtype)
+        finally:
+            if writer is not None:
+                writer.close()
 
-        print(f"CSV file has been created: {output_csv}")
+        # Drop rows computed with other model weights and duplicate rows
+        if compact_feature_store:
+            embedding_store.compact()
+            xray_store.compact()
+
+        print(f"Dataset file has been created: {output_csv}")
 
     except Exception as e:
         # Handle any errors that occur during the process
         print(f"An error occurred: {str(e)}")
 
-# Function to process an image using BLIP and return its embedding
-def process_image(image_path, processor, model, device):
+# Function to locate the feature store folder used when none is given: next to the output
+def default_feature_store_dir(output_csv):
+    return os.path.join(os.path.dirname(os.path.abspath(output_csv)), "feature_store")
+
+# Function to open one feature store of a build. Shards may run concurrently, so a shard reads the
+# shared store without writing to it and appends its new vectors to a store of its own, which
+# merge folds back into the shared one (see merge_feature_stores).
+def open_feature_store(feature_store_dir, name, model_id, dim, shard=None):
+    shared_root = os.path.join(feature_store_dir, name)
+    if not shard:
+        return FeatureStore(shared_root, model_id, dim)
+    shared = FeatureStore(shared_root, model_id, dim, read_only=True)
+    own_root = os.path.join(feature_store_dir, f"shard-{shard[0]}-of-{shard[1]}", name)
+    return LayeredFeatureStore(shared, FeatureStore(own_root, model_id, dim, columns=shared.columns))
+
+# Function to check the inputs of a build without loading any model or writing any file:
+# the folders exist, how the reports pair with images (and which shard gets them), and that
+# the paired images can be opened. Returns True when the build can run.
+def dry_run(txt_folder, img_folder1, img_folder2, output_csv, shard=None, output_format="csv"):
+    from PIL import Image
+
+    missing = [folder for folder in (txt_folder, img_folder1, img_folder2) if not os.path.isdir(folder)]
+    for folder in missing:
+        print(f"Folder not found: {folder}")
+    if missing:
+        return False
+
+    # Pair the reports exactly as a build does, without reading or saving the persistent index
+    txt_files = [f for f in os.listdir(txt_folder) if f.endswith('.txt')]
+    image_index = ImageIndex([img_folder1, img_folder2], None)
+    reports, unmatched_reports, unmatched_images = image_index.match_reports(txt_files, img_folder1, img_folder2)
+    print(f"Found {len(txt_files)} reports; matched {len(reports)}; {len(unmatched_reports)} reports and {len(unmatched_images)} images unmatched.")
+    if shard:
+        reports = [report for report in reports if shard_of(report[0], shard[1]) == shard[0]]
+        output_csv = shard_output_path(output_csv, *shard, output_format)
+        print(f"Shard {shard[0]}/{shard[1]}: {len(reports)} reports")
+
+    # Opening an image only reads its header
+    unreadable = []
+    for txt_file, frontal_image_path, lateral_image_path in reports:
+        for image_path in (frontal_image_path, lateral_image_path):
+            try:
+                with Image.open(image_path):
+                    pass
+            except Exception as e:
+                unreadable.append(image_path)
+                print(f"Unreadable image {image_path}: {str(e)}")
+    print(f"{2 * len(reports) - len(unreadable)} of {2 * len(reports)} paired images readable.")
+    print(f"Would write {len(reports)} reports to {output_csv} ({output_format})")
+    return True
+
+# Batched BLIP image-embedding engine. Only the vision encoder and the visual projection
+# run (the legacy path also ran the text encoder on a dummy caption), under inference_mode.
+# reduction selects how embeddings are reduced to 128 dimensions (see reduce_image_embeds).
+class BlipEmbeddingEngine:
+    def __init__(self, device, batch_size=16, precision="fp32", model_name="Salesforce/blip-image-captioning-base", reduction="projection"):
+        import torch
+        from transformers import BlipProcessor
+
+        if precision not in ("fp32", "bf16", "int8"):
+            raise ValueError(f"Unknown precision: {precision}")
+        if precision == "int8" and device.type != "cpu":
+            raise ValueError("Dynamic int8 quantization is only supported on CPU")
+        if reduction not in REDUCTIONS:
+            raise ValueError(f"Unknown reduction: {reduction}")
+        self.device = device
+        self.batch_size = batch_size
+        self.precision = precision
+        self.reduction = reduction
+        self.model_name = model_name
+        self.model_id = f"{model_name}:{precision}"  # Identifies the weights in the feature store
+        self.processor = BlipProcessor.from_pretrained(model_name)
+        self.dtype = torch.bfloat16 if precision == "bf16" else torch.float32
+        self.model = None
+
+    # Load the BLIP weights the first time an embedding is actually needed
+    def _load_model(self):
+        import torch
+        from transformers import BlipModel
+
+        model = BlipModel.from_pretrained(self.model_name).eval()
+
+        # Optional reduced precision: bf16 weights, or dynamic int8 Linear layers (CPU only)
+        if self.precision == "bf16":
+            model = model.to(torch.bfloat16)
+        elif self.precision == "int8":
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model.to(self.device)
+
+    # Embed a list of PIL images, returning a (N, 128) tensor on the CPU
+    def embed(self, images):
+        import torch
+
+        if not images:
+            return torch.zeros(0, 128)
+        return self.embed_pixels(self.processor(images=images, return_tensors="pt")["pixel_values"])
+
+    # Embed already preprocessed BLIP pixel values of shape (N, 3, H, W)
+    def embed_pixels(self, pixel_values):
+        import torch
+
+        if self.model is None:
+            self._load_model()
+        outputs = []
+        for start in range(0, len(pixel_values), self.batch_size):
+            chunk = pixel_values[start:start + self.batch_size].to(self.device, dtype=self.dtype)
+            with torch.inference_mode():
+                # The projected pooled vision output, as BlipModel computes image_embeds; get_image_features
+                # returns an output object instead of a tensor on newer transformers releases
+                image_embeds = self.model.visual_projection(self.model.vision_model(pixel_values=chunk).pooler_output)
+                # BlipModel returns L2-normalised image embeddings
+                image_embeds = image_embeds / image_embeds.norm(p=2, dim=-1, keepdim=True)
+                outputs.append(reduce_image_embeds(image_embeds.float(), self.reduction).cpu())
+        return torch.cat(outputs, dim=0) if outputs else torch.zeros(0, 128)
+
+    # Embed images from disk; images that cannot be read get a zero embedding
+    def embed_paths(self, image_paths):
+        import torch
+        from PIL import Image
+
+        images, loaded = [], []
+        for i, image_path in enumerate(image_paths):
+            try:
+                images.append(Image.open(image_path).convert('RGB'))
+                loaded.append(i)
+            except Exception as e:
+                print(f"Error processing image {image_path}: {str(e)}")
+
+        embeddings = torch.zeros(len(image_paths), 128)
+        if images:
+            embeddings[loaded] = self.embed(images)
+        return embeddings
+
+# Dataset that decodes each report's frontal and lateral image exactly once and prepares
+# both the BLIP pixel values and the 224px grayscale XRayVision input of the frontal view
+# Images whose content hash is already in a feature store are hashed but not decoded.
+# A plain map-style dataset (__len__ and __getitem__), which is all DataLoader needs.
+class XRayReportDataset:
+    def __init__(self, reports, image_processor, xray_transform, embedded_hashes=(), classified_hashes=()):
+        self.reports = reports  # List of (txt_file, frontal_image_path, lateral_image_path)
+        self.image_processor = image_processor
+        self.xray_transform = xray_transform
+        self.embedded_hashes = set(embedded_hashes)
+        self.classified_hashes = set(classified_hashes)
+
+    def __len__(self):
+        return len(self.reports)
+
+    def __getitem__(self, index):
+        import torch
+        from PIL import Image
+
+        txt_file, frontal_image_path, lateral_image_path = self.reports[index]
+        size = self.image_processor.size
+        pixel_values = torch.zeros(2, 3, size["height"], size["width"])
+        pixel_ok = torch.zeros(2, dtype=torch.bool)
+        hashes = [None, None]
+        xray = torch.zeros(1, 224, 224)
+        xray_ok = False
+
+        for view, image_path in enumerate((frontal_image_path, lateral_image_path)):
+            try:
+                # Read the file once: the bytes are both hashed and decoded
+                with open(image_path, 'rb') as f:
+                    data = f.read()
+                hashes[view] = content_hash(data)
+                need_embedding = hashes[view] not in self.embedded_hashes
+                need_xray = view == 0 and hashes[view] not in self.classified_hashes
+                if not (need_embedding or need_xray):
+                    continue
+                image = Image.open(io.BytesIO(data)).convert('RGB')
+                if need_embedding:
+                    pixel_values[view] = self.image_processor(images=image, return_tensors="pt")["pixel_values"][0]
+                    pixel_ok[view] = True
+            except Exception as e:
+                print(f"Error processing image {image_path}: {str(e)}")
+                continue
+
+            # Reuse the decoded frontal image for classification
+            if need_xray:
+                try:
+                    xray = torch.from_numpy(preprocess_xray(np.asarray(image), self.xray_transform))
+                    xray_ok = True
+                except Exception as e:
+                    print(f"Error classifying X-ray {image_path}: {str(e)}")
+
+        return {"txt_file": txt_file, "hashes": hashes, "pixel_values": pixel_values, "pixel_ok": pixel_ok, "xray": xray, "xray_ok": xray_ok}
+
+# Function to collate report samples, interleaving frontal and lateral images for BLIP
+def collate_reports(samples):
+    import torch
+
+    return {
+        "txt_files": [sample["txt_file"] for sample in samples],
+        "hashes": [image_hash for sample in samples for image_hash in sample["hashes"]],
+        "pixel_values": torch.cat([sample["pixel_values"] for sample in samples], dim=0),
+        "pixel_ok": torch.cat([sample["pixel_ok"] for sample in samples], dim=0),
+        "xray": torch.stack([sample["xray"] for sample in samples], dim=0),
+        "xray_ok": [sample["xray_ok"] for sample in samples],
+    }
+
+# Function to build the matrix of a 1D linear resize from in_size to out_size samples, as done by
+# F.interpolate(mode='linear'/'bilinear', align_corners=False): resized = matrix @ samples
+@lru_cache(maxsize=None)
+def interpolation_matrix(in_size, out_size):
+    matrix = np.zeros((out_size, in_size))
+    source = np.maximum((np.arange(out_size) + 0.5) * in_size / out_size - 0.5, 0)
+    lower = np.floor(source).astype(int)
+    upper = np.minimum(lower + 1, in_size - 1)
+    weight = source - lower
+    np.add.at(matrix, (np.arange(out_size), lower), 1 - weight)
+    np.add.at(matrix, (np.arange(out_size), upper), weight)
+    return matrix
+
+# Function to precompute the reduction of a grid_size x grid_size grid of dim-wide patch embeddings.
+# Bilinear upsampling to 128x128 followed by the grid mean weighs every patch by the product of the
+# column means of the two 1D resize matrices, and the final linear resize is a dim x 128 matrix, so the
+# whole reduction is (patch_weights @ patches) @ projection. Cached per shape, device and dtype.
+@lru_cache(maxsize=None)
+def reduction_weights(grid_size, dim, device, dtype):
+    import torch
+
+    grid_weights = interpolation_matrix(grid_size, 128).mean(axis=0)
+    patch_weights = np.outer(grid_weights, grid_weights).reshape(-1)
+    projection = interpolation_matrix(dim, 128).T
+    return (torch.from_numpy(patch_weights).to(device=device, dtype=dtype),
+            torch.from_numpy(projection).to(device=device, dtype=dtype))
+
+# Function to reduce a batch of BLIP image embeddings to 128 dimensions, exactly as process_image does.
+# Accepts pooled embeddings (B, D) or patch embeddings (B, N, D).
+# method "projection" applies the precomputed reduction_weights in two small matmuls; "interpolate"
+# runs the original F.interpolate steps, materialising the (B, D, 128, 128) upsampled grid.
+# Both agree to float32 rounding.
+def reduce_image_embeds(image_embeds, method="projection"):
+    import torch.nn.functional as F
+
+    # Treat a pooled embedding as a 1x1 patch grid
+    if len(image_embeds.shape) == 2:
+        image_embeds = image_embeds.unsqueeze(1)
+
+    # If there is a CLS token, remove it
+    if image_embeds.shape[1] > 576:
+        image_embeds = image_embeds[:, 1:, :]
+
+    batch, tokens, dim = image_embeds.shape
+    grid_size = int(tokens**0.5)
+    if method == "projection":
+        if grid_size * grid_size != tokens:
+            raise ValueError(f"{tokens} patch embeddings do not form a square grid")
+        patch_weights, projection = reduction_weights(grid_size, dim, image_embeds.device, image_embeds.dtype)
+        averaged_embeds = patch_weights @ image_embeds  # Shape: (B, D)
+        return averaged_embeds @ projection  # Shape: (B, 128)
+
+    # Reshape into a grid, interpolate to 128x128 and average over the grid
+    image_embeds = image_embeds.reshape(batch, grid_size, grid_size, dim)
+    interpolated_embeds = F.interpolate(image_embeds.permute(0, 3, 1, 2), size=(128, 128), mode='bilinear', align_corners=False)
+    averaged_embeds = interpolated_embeds.mean(dim=(2, 3))  # Shape: (B, D)
+
+    # Further downsample to a 128-dimensional embedding
+    final_embeds = F.interpolate(averaged_embeds.unsqueeze(1), size=(128,), mode='linear', align_corners=False)
+    return final_embeds.squeeze(1)  # Shape: (B, 128)
+
+# Function to process an image using BLIP and return its embedding.
+# reduction "projection" reduces the embedding with the precomputed reduction_weights instead of the steps below.
+def process_image(image_path, processor, model, device, reduction="interpolate"):
+    import torch
+    import torch.nn.functional as F
+    from PIL import Image
+
     try:
         # Load the image and convert it to RGB (color)
         image = Image.open(image_path).convert('RGB')
@@ -104,6 +437,8 @@ def process_image(image_path, processor, model, device):
 
         # Extract the image embeddings from the BLIP model's output
         image_embeds = outputs.image_embeds
+        if reduction == "projection":
+            return reduce_image_embeds(image_embeds, "projection").cpu()
 
         # Add a dimension if the embedding is 2D (required for further processing)
         if len(image_embeds.shape) == 2:
@@ -135,24 +470,75 @@ def process_image(image_path, processor, model, device):
         print(f"Error processing image {image_path}: {str(e)}")
         return torch.zeros(1, 128)  # Return a zero tensor in case of error
 
+# Function to build the XRayVision crop/resize transform once per process
+@lru_cache(maxsize=None)
+def get_xray_transform():
+    import torchvision
+    import torchxrayvision as xrv
+
+    return torchvision.transforms.Compose([xrv.datasets.XRayCenterCrop(), xrv.datasets.XRayResizer(224)])
+
+# Function to turn a decoded 8-bit image array into the XRayVision 224px grayscale input
+def preprocess_xray(img, transform=None):
+    import torchxrayvision as xrv
+
+    img = xrv.datasets.normalize(img, 255)  # Normalize 8-bit image to [-1024, 1024] range
+    img = img.mean(2)[None, ...]  # Convert to grayscale (single color channel)
+    transform = transform or get_xray_transform()
+    return transform(img).astype(np.float32)
+
+# Batched XRayVision DenseNet classifier working on preprocessed (1, 224, 224) tensors
+class XRayClassifier:
+    def __init__(self, device, batch_size=32, weights=XRAY_WEIGHTS):
+        self.device = device
+        self.batch_size = batch_size
+        self.weights = weights
+        self.transform = get_xray_transform()
+        self.model = None
+
+    @property
+    def pathologies(self):
+        if self.model is None:
+            import torchxrayvision as xrv
+
+            self.model = xrv.models.DenseNet(weights=self.weights).to(self.device).eval()
+        return self.model.pathologies
+
+    # Classify a list or tensor of preprocessed images; returns a (pathologies, images) float32 matrix
+    def classify(self, images):
+        import torch
+
+        pathologies = self.pathologies  # Loads the model if needed
+        scores = np.zeros((len(pathologies), len(images)), dtype=np.float32)
+        for start in range(0, len(images), self.batch_size):
+            chunk = images[start:start + self.batch_size]
+            chunk = chunk if torch.is_tensor(chunk) else torch.stack(list(chunk))
+            with torch.inference_mode():
+                outputs = self.model(chunk.to(self.device))
+            scores[:, start:start + len(chunk)] = outputs.cpu().numpy().T
+        return scores
+
+# Function to classify a preprocessed X-ray tensor of shape (1, 224, 224)
+def classify_xray_tensor(img, model, device):
+    import torch
+
+    # Run the X-ray image through the DenseNet model
+    with torch.inference_mode():
+        outputs = model(img[None, ...].to(device))
+
+    # Map the model's output to pathology names and probabilities
+    return dict(zip(model.pathologies, outputs[0].cpu().numpy()))
+
 # Function to classify an X-ray image using the XRayVision model
 def classify_xray(image_path, model, device):
+    import skimage.io
+    import torch
+
     try:
         # Read and normalize the image for X-ray classification
         img = skimage.io.imread(image_path)
-        img = xrv.datasets.normalize(img, 255)  # Normalize 8-bit image to [-1024, 1024] range
-        img = img.mean(2)[None, ...]  # Convert to grayscale (single color channel)
-        transform = torchvision.transforms.Compose([xrv.datasets.XRayCenterCrop(), xrv.datasets.XRayResizer(224)])
-        img = transform(img)
-        img = torch.from_numpy(img).to(device)
-
-        # Run the X-ray image through the DenseNet model
-        with torch.no_grad():
-            outputs = model(img[None, ...])
-
-        # Map the model's output to pathology names and probabilities
-        results = dict(zip(model.pathologies, outputs[0].cpu().detach().numpy()))
-        return results
+        img = torch.from_numpy(preprocess_xray(img))
+        return classify_xray_tensor(img, model, device)
 
     except Exception as e:
         # Handle errors during classification
@@ -160,29 +546,133 @@ def classify_xray(image_path, model, device):
         return {}  # Return an empty dictionary in case of error
 
 #BCE Prompting
-def create_combined_prompt(blip_embedding, classification_result):
-    # Convert BLIP embeddings to a readable string
-    blip_str = ', '.join(map(str, blip_embedding.tolist()))
-
-    # Format classification results as "Condition: Probability%" strings
-    classification_str = '\n'.join([f"{condition}: {probability*100:.2f}" for condition, probability in classification_result.items()])
-
-    # Combine everything into the desired prompt format
-    combined_prompt = (
-        f"BLIP Embeddings:\n[{blip_str}]\n\n"
-        f"Classification Results (%):\n"
-        f"{classification_str}\n"
-        f"Context: AI radiologist assistant analyzing BLIP-processed chest X-ray.\n"
-        f"Limit: 7 sentences."
-    )
-
-    return combined_prompt
-
-# Example usage of the function
-txt_folder = 'path_to_IU-XRay_datset_findings'
-img_folder1 = 'Path_Frontal_XRay_image_split'
-img_folder2 = 'Path_Lateral_XRay_image_split'
-output_csv = 'path_to_save_generated_dataset.csv'
-
-# Call the main function to find matching files and process them
-find_matching_files_and_process(txt_folder, img_folder1, img_folder2, output_csv)
+def create_combined_prompt(blip_embedding, classification_result, precision=None):
+    return format_bce_input(blip_embedding.tolist(), classification_result.items(), precision)
+
+# Function to open the dataset writer: a CSV of rendered BCE prompts, or compact Parquet
+# with the raw embeddings and scores (rendered later by bce_format.load_bce_dataset)
+def open_dataset_writer(output_path, output_format, pathologies, with_ids=False, embedding_dtype="float32"):
+    if output_format == "parquet":
+        return BCEParquetWriter(output_path, pathologies, embedding_dtype)
+    return BCECSVWriter(output_path, pathologies, with_ids)
+
+# Function to assign a report to one of num_shards shards by a stable hash of its name
+def shard_of(txt_file, num_shards):
+    return int(hashlib.sha1(txt_file.encode('utf-8')).hexdigest(), 16) % num_shards
+
+# Function to parse a "--shard i/N" value
+def parse_shard(value):
+    index, _, count = value.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must look like i/N, got {value!r}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be in 0..N-1, got {value!r}")
+    return index, count
+
+# Function to name the part file written by one shard
+def shard_output_path(output_csv, index, count, output_format="csv"):
+    stem, _ = os.path.splitext(output_csv)
+    return f"{stem}.part-{index:05d}-of-{count:05d}.{output_format}"
+
+# Function to merge shard part files into one CSV sorted and deduplicated by report id.
+# The result is byte-identical to an unsharded run over the same reports.
+def merge_shards(part_files, output_csv):
+    if all(part_file.endswith(".parquet") for part_file in part_files):
+        count = merge_parquet(part_files, output_csv)
+        print(f"Merged {count} reports from {len(part_files)} part files into {output_csv}")
+        return
+
+    rows = {}
+    for part_file in sorted(part_files):
+        with open(part_file, 'r', newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            next(reader)  # Skip the header
+            for row in reader:
+                rows.setdefault(row[0], row[1:])
+
+    with open(output_csv, 'w', newline='', encoding='utf-8') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(['Instruction', 'Input', 'Output'])
+        for report_id in sorted(rows):
+            csvwriter.writerow(rows[report_id])
+    print(f"Merged {len(rows)} reports from {len(part_files)} part files into {output_csv}")
+
+# Function to fold the per-shard feature stores of a sharded build into the shared stores and remove
+# them, so later builds with any shard count (or none) reuse every embedding and score
+def merge_feature_stores(feature_store_dir):
+    shard_dirs = sorted(glob.glob(os.path.join(feature_store_dir, "shard-*-of-*")))
+    if not shard_dirs:
+        return
+    for name in ("blip", "densenet"):
+        shard_roots = [os.path.join(shard_dir, name) for shard_dir in shard_dirs
+                       if os.path.exists(os.path.join(shard_dir, name, "meta.json"))]
+        if not shard_roots:
+            continue
+        added = merge_stores(os.path.join(feature_store_dir, name), shard_roots)
+        print(f"Merged {added} {name} vectors from {len(shard_roots)} shard stores into {feature_store_dir}")
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+
+# Function to parse command-line options
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Create the MTD dataset with BCE prompts from IU X-Ray reports and images.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Embed, classify and write the dataset (or one shard of it)")
+    build.add_argument("txt_folder", help="Folder of IU X-Ray findings .txt files")
+    build.add_argument("frontal_folder", help="Folder of frontal X-ray images")
+    build.add_argument("lateral_folder", help="Folder of lateral X-ray images")
+    build.add_argument("output_csv", help="Dataset file to write (.csv or .parquet)")
+    build.add_argument("--batch-size", type=int, default=16, help="Images per BLIP / DenseNet forward pass")
+    build.add_argument("--precision", choices=["fp32", "bf16", "int8"], default="fp32", help="BLIP precision (int8 is dynamic quantization, CPU only)")
+    build.add_argument("--num-workers", type=int, default=4, help="Image decode worker processes")
+    build.add_argument("--feature-store", default=None, help="Feature store folder (default: feature_store next to the output)")
+    build.add_argument("--compact-feature-store", action="store_true", help="Compact the feature stores after the run")
+    build.add_argument("--shard", type=parse_shard, default=None, help="Process only shard i of N (written to a part file)")
+    build.add_argument("--format", choices=["csv", "parquet"], default=None,
+                       help="Output format (default: from the output file extension); parquet stores raw embeddings and scores")
+    build.add_argument("--embedding-dtype", choices=["float32", "float16"], default="float32", help="Precision of the stored BLIP embeddings")
+    build.add_argument("--embedding-reduction", choices=REDUCTIONS, default="projection",
+                       help="Reduce BLIP embeddings to 128 dimensions with the precomputed projection or the original interpolation steps")
+    build.add_argument("--dry-run", action="store_true", help="Check the folders, pairing and images without loading models or writing output")
+
+    merge = subparsers.add_parser("merge", help="Merge shard part files into the final dataset")
+    merge.add_argument("output_csv", help="Dataset file to write (.csv or .parquet, matching the part files)")
+    merge.add_argument("part_files", nargs="+", help="Part files written by build --shard")
+    merge.add_argument("--feature-store", default=None, help="Feature store folder whose shard stores are folded in (default: feature_store next to the output)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "merge":
+        merge_shards(args.part_files, args.output_csv)
+        merge_feature_stores(args.feature_store or default_feature_store_dir(args.output_csv))
+        return
+
+    output_format = args.format or ("parquet" if args.output_csv.endswith(".parquet") else "csv")
+    if args.dry_run:
+        if not dry_run(args.txt_folder, args.frontal_folder, args.lateral_folder, args.output_csv, args.shard, output_format):
+            sys.exit(1)
+        return
+
+    # Call the main function to find matching files and process them
+    find_matching_files_and_process(args.txt_folder, args.frontal_folder, args.lateral_folder, args.output_csv,
+                                    args.batch_size, args.precision, args.num_workers,
+                                    feature_store_dir=args.feature_store,
+                                    compact_feature_store=args.compact_feature_store, shard=args.shard,
+                                    output_format=output_format, embedding_dtype=args.embedding_dtype,
+                                    reduction=args.embedding_reduction)
+
+# Example usage:
+#   python MTD_dc.py build path_to_IU-XRay_datset_findings Path_Frontal_XRay_image_split Path_Lateral_XRay_image_split path_to_save_generated_dataset.csv
+# Sharded across four processes, then merged:
+#   python MTD_dc.py build ... dataset.csv --shard 0/4   (and 1/4, 2/4, 3/4)
+#   python MTD_dc.py merge dataset.csv dataset.part-*-of-00004.csv
+# Compact Parquet output (prompts are rendered on load with bce_format.load_bce_dataset):
+#   python MTD_dc.py build ... dataset.parquet --embedding-dtype float16
+# Check the inputs and pairing first, without loading the models:
+#   python MTD_dc.py build ... dataset.csv --dry-run
+if __name__ == "__main__":
+    main()
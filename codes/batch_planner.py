@@ -0,0 +1,76 @@
+import math
+import re
+
+UNITS = ["", "ONE", "TWO", "THREE", "FOUR", "FIVE", "SIX", "SEVEN", "EIGHT", "NINE",
+         "TEN", "ELEVEN", "TWELVE", "THIRTEEN", "FOURTEEN", "FIFTEEN", "SIXTEEN",
+         "SEVENTEEN", "EIGHTEEN", "NINETEEN"]
+TENS = ["", "", "TWENTY", "THIRTY", "FORTY", "FIFTY", "SIXTY", "SEVENTY", "EIGHTY", "NINETY"]
+ORDINAL_UNITS = {
+    "ONE": "FIRST", "TWO": "SECOND", "THREE": "THIRD", "FIVE": "FIFTH", "EIGHT": "EIGHTH",
+    "NINE": "NINTH", "TWELVE": "TWELFTH",
+}
+
+# Rough per-finding size of the model outputs, used when no better estimate exists
+DETAILED_TOKENS_PER_FINDING = 160
+ANALYSIS_TOKENS_PER_FINDING = 90
+
+# Function to spell out a positive integer below one million in upper-case English words
+def number_words(n):
+    if n < 20:
+        return UNITS[n]
+    if n < 100:
+        return TENS[n // 10] + ("-" + UNITS[n % 10] if n % 10 else "")
+    if n < 1000:
+        rest = n % 100
+        return UNITS[n // 100] + " HUNDRED" + (" " + number_words(rest) if rest else "")
+    rest = n % 1000
+    return number_words(n // 1000) + " THOUSAND" + (" " + number_words(rest) if rest else "")
+
+# Function to turn a position into its ordinal word (1 -> FIRST, 21 -> TWENTY-FIRST)
+def ordinal(n):
+    if n < 1:
+        raise ValueError("Ordinals start at 1")
+    words = number_words(n)
+    split = max(words.rfind(" "), words.rfind("-")) + 1
+    head, last = words[:split], words[split:]
+    if last in ORDINAL_UNITS:
+        last = ORDINAL_UNITS[last]
+    elif last.endswith("Y"):
+        last = last[:-1] + "IETH"
+    else:
+        last += "TH"
+    return head + last
+
+# Function to estimate the token count of a text without calling the API.
+# Gemini's tokenizer averages roughly four characters per token on English prose,
+# and counting words keeps short reports full of abbreviations from being underestimated.
+def estimate_tokens(text):
+    return max(math.ceil(len(text) / 4), len(re.findall(r"\w+|[^\w\s]", text)) * 3 // 4, 1)
+
+# Function to estimate the prompt and response cost a single finding adds to a batch
+def estimate_finding_cost(text):
+    input_tokens = estimate_tokens(text)
+    detailed_tokens = max(DETAILED_TOKENS_PER_FINDING, int(input_tokens * 1.5))
+    # The finding appears in the CPIR-MR prompt, and again with its detailed output in the CPMK-E prompt
+    prompt_tokens = 2 * input_tokens + detailed_tokens + 20
+    response_tokens = max(detailed_tokens, ANALYSIS_TOKENS_PER_FINDING)
+    return prompt_tokens, response_tokens
+
+# Function to pack files into batches that fit the prompt and response token budgets
+def plan_batches(files, texts, prompt_token_budget, response_token_budget, max_batch_size=None):
+    batches = []
+    current, prompt_used, response_used = [], 0, 0
+    for file_name, text in zip(files, texts):
+        prompt_tokens, response_tokens = estimate_finding_cost(text)
+        over_budget = (prompt_used + prompt_tokens > prompt_token_budget
+                       or response_used + response_tokens > response_token_budget)
+        full = max_batch_size is not None and len(current) >= max_batch_size
+        if current and (over_budget or full):
+            batches.append(current)
+            current, prompt_used, response_used = [], 0, 0
+        current.append(file_name)
+        prompt_used += prompt_tokens
+        response_used += response_tokens
+    if current:
+        batches.append(current)
+    return batches
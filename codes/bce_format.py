@@ -0,0 +1,139 @@
+import csv
+import json
+
+import numpy as np
+
+# Rows are written in groups of this size so a file's layout only depends on its rows
+ROW_GROUP_SIZE = 1024
+CONTEXT = "Context: AI radiologist assistant analyzing BLIP-processed chest X-ray.\nLimit: 7 sentences."
+
+# Function to format a float for the BCE prompt; None keeps the full repr used by the CSV output
+def format_float(value, precision=None):
+    return str(value) if precision is None else f"{value:.{precision}f}"
+
+# Function to render the BCE prompt input from BLIP embeddings and pathology scores.
+# blip_embedding is a list of per-view embedding lists; classification is (condition, probability) pairs.
+def format_bce_input(blip_embedding, classification, precision=None):
+    # Convert BLIP embeddings to a readable string
+    if precision is None:
+        blip_str = ', '.join(map(str, blip_embedding))
+    else:
+        blip_str = ', '.join('[' + ', '.join(format_float(v, precision) for v in view) + ']' for view in blip_embedding)
+
+    # Format classification results as "Condition: Probability%" strings
+    classification_str = '\n'.join([f"{condition}: {probability*100:.2f}" for condition, probability in classification])
+
+    # Combine everything into the desired prompt format
+    return (
+        f"BLIP Embeddings:\n[{blip_str}]\n\n"
+        f"Classification Results (%):\n"
+        f"{classification_str}\n"
+        f"{CONTEXT}"
+    )
+
+# Function to build the Arrow schema of the compact BCE dataset
+def bce_schema(pathologies, embedding_dtype="float32", views=2, dim=128):
+    import pyarrow as pa
+
+    value_type = pa.float16() if embedding_dtype == "float16" else pa.float32()
+    metadata = {"bce": json.dumps({"pathologies": list(pathologies), "views": views, "dim": dim})}
+    return pa.schema([
+        ("id", pa.string()),
+        ("instruction", pa.string()),
+        ("embedding", pa.list_(value_type, views * dim)),
+        ("scores", pa.list_(pa.float32(), len(pathologies))),  # Null when the image was not classified
+        ("output", pa.string()),
+    ], metadata=metadata)
+
+# CSV writer for the BCE dataset with fully rendered prompts; shard part files also carry the report id
+class BCECSVWriter:
+    def __init__(self, path, pathologies, with_ids=False):
+        self.pathologies = list(pathologies)
+        self.with_ids = with_ids
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        # Write the header row in the CSV
+        self.writer.writerow(['Id', 'Instruction', 'Input', 'Output'] if with_ids else ['Instruction', 'Input', 'Output'])
+
+    # Render and write one row; blip_embedding is a list of per-view embedding lists
+    def write_row(self, report_id, instruction, blip_embedding, scores, output):
+        classification = zip(self.pathologies, scores) if scores is not None else []
+        row = [instruction, format_bce_input(blip_embedding, classification), output]
+        self.writer.writerow([report_id] + row if self.with_ids else row)
+
+    def close(self):
+        self.file.close()
+
+# Parquet writer for the compact BCE dataset: raw embedding vectors and pathology scores
+# instead of stringified prompts, which are rendered when the dataset is loaded.
+class BCEParquetWriter:
+    def __init__(self, path, pathologies, embedding_dtype="float32"):
+        import pyarrow.parquet as pq
+
+        self.schema = bce_schema(pathologies, embedding_dtype)
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.pending = []
+
+    # Queue one row; blip_embedding is a list of per-view embedding lists, scores is None or one value per pathology
+    def write_row(self, report_id, instruction, blip_embedding, scores, output):
+        embedding = [value for view in blip_embedding for value in view]
+        self.pending.append({"id": report_id, "instruction": instruction, "embedding": embedding,
+                             "scores": None if scores is None else list(scores), "output": output})
+        if len(self.pending) >= ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        import pyarrow as pa
+
+        if self.pending:
+            self.writer.write_table(pa.Table.from_pylist(self.pending, schema=self.schema))
+            self.pending = []
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+# Function to merge Parquet part files into one file sorted and deduplicated by id
+def merge_parquet(part_files, output_path):
+    import pyarrow.parquet as pq
+
+    tables = [pq.read_table(part_file) for part_file in sorted(part_files)]
+    schema = tables[0].schema
+    rows = {}
+    for table in tables:
+        for row in table.to_pylist():
+            rows.setdefault(row["id"], row)
+
+    bce = json.loads(schema.metadata[b"bce"])
+    embedding_dtype = "float16" if str(schema.field("embedding").type.value_type) == "halffloat" else "float32"
+    writer = BCEParquetWriter(output_path, bce["pathologies"], embedding_dtype)
+    views, dim = bce["views"], bce["dim"]
+    for report_id in sorted(rows):
+        row = rows[report_id]
+        blip_embedding = [row["embedding"][view * dim:(view + 1) * dim] for view in range(views)]
+        writer.write_row(row["id"], row["instruction"], blip_embedding, row["scores"], row["output"])
+    writer.close()
+    return len(rows)
+
+# Function to load a compact BCE dataset and render its prompts lazily.
+# Yields {"id", "instruction", "input", "output"} dicts; precision sets the decimals of the
+# embedding values (None reproduces the CSV output for float32 embeddings).
+def load_bce_dataset(path, precision=None, batch_size=1024):
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    bce = json.loads(parquet_file.schema_arrow.metadata[b"bce"])
+    pathologies, views, dim = bce["pathologies"], bce["views"], bce["dim"]
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        for row in batch.to_pylist():
+            embedding = row["embedding"]
+            blip_embedding = [embedding[view * dim:(view + 1) * dim] for view in range(views)]
+            # Score arithmetic stays in float32, as in the CSV output
+            scores = row["scores"]
+            classification = zip(pathologies, np.asarray(scores, dtype=np.float32)) if scores is not None else []
+            yield {
+                "id": row["id"],
+                "instruction": row["instruction"],
+                "input": format_bce_input(blip_embedding, classification, precision),
+                "output": row["output"],
+            }
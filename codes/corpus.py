@@ -0,0 +1,112 @@
+import os
+import json
+import mmap
+import zipfile
+
+# Function to decode report bytes the way open(path, 'r') does on the loose files
+def decode_text(data):
+    return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+# Memory map usable as the file object of a ZipFile (mmap only reports seekable() from Python 3.13)
+class MappedFile(mmap.mmap):
+    def seekable(self):
+        return True
+
+# Read-only access to a corpus of reports keyed by file name (e.g. "CXR1.txt"), wherever it is stored:
+#   - a folder of .txt files ("./findings")
+#   - a zip archive, optionally narrowed to a subfolder ("eclectic/gemini1.5flash.zip:keywords").
+#     A single top-level folder in the archive is skipped, so "findings.zip" lists "CXR1.txt".
+#   - a consolidated JSONL or Parquet corpus written by xml2txt.py; its report ids get a ".txt" suffix
+# Zip archives and Parquet files are memory-mapped unless use_mmap is False.
+class Corpus:
+    def __init__(self, source, use_mmap=True):
+        self.source = source
+        self.path, self.subfolder = source, ''
+        if not os.path.exists(source) and ':' in source:
+            self.path, self.subfolder = source.rsplit(':', 1)
+        self.archive = None
+        self.mapped = None
+        self.texts = None
+        self.members = {}
+
+        if os.path.isdir(self.path):
+            self.kind = "folder"
+            self.members = {name: os.path.join(self.path, name) for name in os.listdir(self.path)
+                            if os.path.isfile(os.path.join(self.path, name))}
+        elif zipfile.is_zipfile(self.path):
+            self.kind = "zip"
+            self._open_zip(use_mmap)
+        elif self.path.endswith('.jsonl'):
+            self.kind = "jsonl"
+            self.texts = {}
+            with open(self.path, 'r', encoding='utf-8') as corpus_file:
+                for line in corpus_file:
+                    record = json.loads(line)
+                    self.texts[f"{record['id']}.txt"] = record.get('text', record.get('findings'))
+        elif self.path.endswith('.parquet'):
+            self.kind = "parquet"
+            import pyarrow.parquet as pq
+
+            table = pq.read_table(self.path, memory_map=use_mmap)
+            text_column = 'text' if 'text' in table.column_names else 'findings'
+            self.texts = {f"{report_id}.txt": text for report_id, text in
+                          zip(table.column('id').to_pylist(), table.column(text_column).to_pylist())}
+        else:
+            raise ValueError(f"Unsupported corpus source: {source}")
+
+    # Index the archive's central directory once: member name -> ZipInfo
+    def _open_zip(self, use_mmap):
+        archive_file = open(self.path, 'rb')
+        if use_mmap:
+            self.mapped = MappedFile(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+            archive_file.close()
+            archive_file = self.mapped
+        self.archive = zipfile.ZipFile(archive_file)
+
+        infos = [info for info in self.archive.infolist() if not info.is_dir()]
+        top_folders = {info.filename.split('/', 1)[0] for info in infos}
+        prefix = f"{top_folders.pop()}/" if len(top_folders) == 1 and all('/' in info.filename for info in infos) else ""
+        if self.subfolder:
+            prefix += self.subfolder.strip('/') + '/'
+        for info in infos:
+            if info.filename.startswith(prefix) and '/' not in info.filename[len(prefix):]:
+                self.members[info.filename[len(prefix):]] = info
+
+    # Sorted report file names
+    def names(self):
+        return sorted(self.texts if self.texts is not None else self.members)
+
+    def __len__(self):
+        return len(self.texts if self.texts is not None else self.members)
+
+    def __contains__(self, name):
+        return name in (self.texts if self.texts is not None else self.members)
+
+    # Text of one report, or None if the corpus does not have it
+    def read(self, name):
+        if self.texts is not None:
+            return self.texts.get(name)
+        member = self.members.get(name)
+        if member is None:
+            return None
+        if self.kind == "folder":
+            with open(member, 'r', encoding='utf-8') as f:
+                return f.read()
+        return decode_text(self.archive.read(member))
+
+    # Yield (name, text) for every report in name order
+    def __iter__(self):
+        for name in self.names():
+            yield name, self.read(name)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+        if self.mapped is not None:
+            self.mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,25 +1,31 @@
 import os
 import re
+import time
+import argparse
 from tqdm import tqdm
-import google.generativeai as genai
+from llm_backend import FakeBackend, GeminiBackend, join_contents
+from dispatcher import BatchDispatcher, RateLimitedModel, TokenBucket
+from response_cache import CACHE_MODES, CachedModel, ResponseCache
+from run_manifest import RunManifest, file_checksum, text_hash
+from batch_planner import estimate_finding_cost, estimate_tokens, ordinal, plan_batches
+from response_parser import parse_detailed_sections, parse_pair_sections, request_with_retry
+from corpus import Corpus
+from tracing import Tracer, trace_stream
+from dedup import DEDUP_MODES, group_duplicates, group_members, write_mapping_report
 
 # Define constants for easier configuration and maintenance
-BATCH_SIZE = 20
+MAX_BATCH_SIZE = 50  # Upper bound on findings per request
+PROMPT_TOKEN_BUDGET = 30000  # Estimated prompt tokens allowed per request
+RESPONSE_TOKEN_BUDGET = 6000  # Estimated response tokens per request, below Gemini's 8192 output limit
 OUTPUT_FOLDER = "./detailed_findings"
 KEYWORDS_FOLDER = "./keywords"
-INPUT_FOLDER = "./findings"
-
-# List of ordinal numbers for generating prompts
-ORDINALS = [
-    "FIRST", "SECOND", "THIRD", "FOURTH", "FIFTH", "SIXTH", "SEVENTH", "EIGHTH", "NINTH", "TENTH",
-    "ELEVENTH", "TWELFTH", "THIRTEENTH", "FOURTEENTH", "FIFTEENTH", "SIXTEENTH", "SEVENTEENTH",
-    "EIGHTEENTH", "NINETEENTH", "TWENTIETH"
-]
-
-# Function to extract sections from the generated text
-def extract_sections(text):
-    sections = re.split(r'\n\n\*\*\d+\. [A-Z]+:\*\*\s*', text)
-    return [section.strip() for section in sections if section]
+INPUT_FOLDER = "./findings"  # Folder, zip archive (e.g. findings.zip) or JSONL/Parquet corpus
+MODEL_NAME = "gemini-1.5-flash"
+CACHE_PATH = "./cache/responses.sqlite"
+MANIFEST_PATH = "./run_manifest.jsonl"
+DEDUP_REPORT_PATH = "./dedup_map.json"
+CONCURRENCY = 4  # Maximum number of model calls in flight
+REQUESTS_PER_MINUTE = 15  # Gemini 1.5 Flash free-tier quota
 
 # Function to create necessary output folders
 def setup_folders():
@@ -27,20 +33,53 @@ def setup_folders():
     os.makedirs(KEYWORDS_FOLDER, exist_ok=True)
 
 # Function to get a sorted list of input files
-def get_input_files():
-    return sorted(os.listdir(INPUT_FOLDER))
+def get_input_files(corpus):
+    return corpus.names()
+
+# Function to drop files the manifest records as complete with unchanged input and outputs
+def get_pending_files(input_files, manifest, corpus):
+    pending = []
+    for file_name in input_files:
+        input_hash = text_hash(corpus.read(file_name))
+        output_paths = {
+            "detailed": os.path.join(OUTPUT_FOLDER, file_name),
+            "keywords": os.path.join(KEYWORDS_FOLDER, file_name),
+        }
+        if not manifest.is_complete(file_name, input_hash, output_paths):
+            pending.append(file_name)
+    return pending
 
-# Function to read the content of a file
-def read_file(file_path):
-    with open(file_path, 'r') as file:
-        return file.read()
+# Function to group the pending files by duplicate findings, so each group reaches the model once.
+# Groups are formed over the whole corpus; returns {representative: pending members} for every
+# group with pending files, together with the assignment of every file to its representative.
+def plan_dedup(corpus, input_files, pending_files, mode):
+    assignments = group_duplicates(input_files, [corpus.read(file) for file in input_files], mode)
+    pending = set(pending_files)
+    groups = {}
+    for representative, members in group_members(assignments).items():
+        pending_members = [file for file in members if file in pending]
+        if pending_members:
+            groups[representative] = pending_members
+    return groups, assignments
+
+# Function to read the outputs a completed file already has on disk
+def read_outputs(file_name):
+    outputs = []
+    for folder in (OUTPUT_FOLDER, KEYWORDS_FOLDER):
+        path = os.path.join(folder, file_name)
+        if not os.path.exists(path):
+            outputs.append(None)
+            continue
+        with open(path, 'r') as output_file:
+            outputs.append(output_file.read())
+    return outputs
 
 # Function to generate the prompt for the Gemini model
 def generate_prompt(texts):
     prompt = f"\n\nI have {len(texts)} examples of original findings. Add your notions in place of XXXX. Strictly DO NOT SUGGEST MEDICINE, PRACTICES.\n\nOriginal Findings:\n"
     prompt += "\n".join(f"{i}. {text}" for i, text in enumerate(texts, 1))
     prompt += f"\n\nFor each finding, generate a more detailed finding for normal human understanding in 7 lines and output those in {len(texts)} points "
-    prompt += " ".join(f"{i}. {ORDINALS[i-1]}: (detailed output)" for i in range(1, len(texts) + 1))
+    prompt += " ".join(f"{i}. {ordinal(i)}: (detailed output)" for i in range(1, len(texts) + 1))
     prompt += "."
     return prompt
 
@@ -60,58 +99,307 @@ def generate_analysis_prompt(texts, detailed_findings):
     prompt += "Pair X:\n1. Original Keywords: [list]\n2. Detailed Keywords: [list]\n3. Similarity Rating: [1-10]\n4. Explanation: [brief explanation]\n\n"
     return prompt
 
+# Function to run the CPIR-MR stage: generate detailed findings for a batch.
+# Returns one detailed finding per text (None if the model never produced it);
+# findings missing from a malformed response are re-requested on their own.
+def generate_detailed_findings(model, texts, tracer=None):
+    tracer = tracer or Tracer()
+    attempts = []
+
+    def request(batch_texts):
+        with tracer.span("model_call", stage="CPIR-MR", items=len(batch_texts), retry=int(bool(attempts))) as call:
+            attempts.append(call)
+            with tracer.span("prompt_build"):
+                prompt = generate_prompt(batch_texts)
+            call.set(prompt_chars=len(prompt))
+            response = model.generate_content(["\n\n", prompt], stream=True)
+            sections, parser = parse_detailed_sections(trace_stream(response, call), len(batch_texts))
+            call.set(sections=len(sections), missing=len(parser.missing()))
+            record_estimated_tokens(call, prompt, parser.buffer)
+            report_malformed("CPIR-MR", parser)
+            return sections
+
+    return request_with_retry(request, texts)
+
+# Function to run the CPMK-E stage: generate analysis for the original and detailed findings.
+# Returns one "Pair" analysis per text (None where there is no detailed finding or analysis).
+def generate_analysis(model, texts, detailed_findings, tracer=None):
+    tracer = tracer or Tracer()
+    indices = [i for i, detailed in enumerate(detailed_findings) if detailed is not None]
+    attempts = []
+
+    def request(pairs):
+        with tracer.span("model_call", stage="CPMK-E", items=len(pairs), retry=int(bool(attempts))) as call:
+            attempts.append(call)
+            with tracer.span("prompt_build"):
+                analysis_prompt = generate_analysis_prompt([original for original, _ in pairs], [detailed for _, detailed in pairs])
+            call.set(prompt_chars=len(analysis_prompt))
+            response = model.generate_content(["\n\n", analysis_prompt], stream=True)
+            sections, parser = parse_pair_sections(trace_stream(response, call), len(pairs))
+            call.set(sections=len(sections), missing=len(parser.missing()))
+            record_estimated_tokens(call, analysis_prompt, parser.buffer)
+            report_malformed("CPMK-E", parser)
+            return sections
+
+    analyses = [None] * len(texts)
+    if indices:
+        for i, analysis in zip(indices, request_with_retry(request, [(texts[i], detailed_findings[i]) for i in indices])):
+            analyses[i] = analysis
+    return analyses
+
+# Function to estimate the token counts of a model call the provider reported none for (the fake
+# backend, cached responses). Estimates go under their own *_tokens_est attributes, so they are
+# never summed together with the prompt_tokens/response_tokens the provider reported.
+def record_estimated_tokens(call, prompt, response_text):
+    if "prompt_tokens" not in call.attributes:
+        call.set(prompt_tokens_est=estimate_tokens(prompt), response_tokens_est=estimate_tokens(response_text))
+
+# Function to log why a response did not line up with its batch
+def report_malformed(stage, parser):
+    problems = list(parser.problems)
+    if parser.missing():
+        problems.append(f"missing {parser.missing()}")
+    if problems:
+        details = "; ".join(problems)
+        print(f"{stage} response malformed ({details}); re-requesting unmatched items.")
+
+# Function to check a response has a section for every item of its prompt. Used as the response
+# cache's validator, so a malformed response is never stored and its retry reaches the model again.
+def complete_response(contents, text):
+    prompt = join_contents(contents)
+    detailed = re.search(r"I have (\d+) examples", prompt)
+    if detailed:
+        _, parser = parse_detailed_sections(text, int(detailed.group(1)))
+    else:
+        _, parser = parse_pair_sections(text, len(re.findall(r"^Original \d+:", prompt, flags=re.M)))
+    return not parser.missing()
+
 # Function to process a batch of files
-def process_batch(model, batch_files):
+def process_batch(model, corpus, batch_files, tracer=None):
     # Read the content of each file in the batch
-    texts = [read_file(os.path.join(INPUT_FOLDER, file)) for file in batch_files]
+    texts = [corpus.read(file) for file in batch_files]
     
     # CPIR-MR -----
-    # Generate detailed findings for the batch
-    prompt = generate_prompt(texts)
-    result = model.generate_content(["\n\n", prompt])
-    extracted_sections = extract_sections(result.text)
+    detailed_findings = generate_detailed_findings(model, texts, tracer)
     
     # CPMK-E ------
-    # Generate analysis for the original and detailed findings
-    analysis_prompt = generate_analysis_prompt(texts, extracted_sections[1:])
-    analysis_result = model.generate_content(["\n\n", analysis_prompt])
-    analysis_sections = analysis_result.text.split("Pair ")
+    analyses = generate_analysis(model, texts, detailed_findings, tracer)
     
-    return extracted_sections, analysis_sections
+    return detailed_findings, analyses
+
+# Function to process all batches concurrently, pipelining CPMK-E of batch k with CPIR-MR of batch k+1
+def process_batches(model, corpus, batches, concurrency=CONCURRENCY, tracer=None):
+    tracer = tracer or Tracer()
+    run_span = tracer.current()  # Stage spans run on worker threads, so their parent is passed explicitly
+    dispatcher = BatchDispatcher(max_in_flight=concurrency, return_exceptions=True)
+
+    # CPIR-MR -----
+    def first_stage(batch_files):
+        with tracer.span("cpir_mr", parent=run_span, batch=batch_files[0], files=len(batch_files)):
+            with tracer.span("read_inputs"):
+                texts = [corpus.read(file) for file in batch_files]
+            return texts, generate_detailed_findings(model, texts, tracer)
+
+    # CPMK-E ------
+    def second_stage(batch_files, intermediate):
+        texts, detailed_findings = intermediate
+        with tracer.span("cpmk_e", parent=run_span, batch=batch_files[0], files=len(batch_files)):
+            return texts, detailed_findings, generate_analysis(model, texts, detailed_findings, tracer)
+
+    return dispatcher.run(batches, first_stage, second_stage)
 
 # Function to write output to a file
 def write_output(output_folder, file_name, content):
     with open(os.path.join(output_folder, file_name), 'w') as output_file:
         output_file.write(content)
 
+# Function to report what a run would do: the pending files, their batches and estimated tokens.
+# Nothing is written and no model or API key is needed.
+def dry_run(args):
+    with Corpus(args.input) as corpus:
+        input_files = get_input_files(corpus)
+        pending_files = input_files
+        if not args.restart:
+            manifest = RunManifest(args.manifest, read_only=True)
+            pending_files = get_pending_files(input_files, manifest, corpus)
+        groups, _ = plan_dedup(corpus, input_files, pending_files, args.dedup)
+        pending = set(pending_files)
+        representatives = [file for file in groups if file in pending]
+        texts = [corpus.read(file) for file in representatives]
+
+    batches = plan_batches(representatives, texts, args.prompt_token_budget, args.response_token_budget, args.max_batch_size)
+    costs = [estimate_finding_cost(text) for text in texts]
+    print(f"{len(input_files)} input files in {args.input}; {len(input_files) - len(pending_files)} already complete.")
+    print(f"{len(pending_files)} files to process; {len(groups) - len(representatives)} groups reuse earlier outputs and "
+          f"{len(representatives)} distinct findings (dedup: {args.dedup}) go out in {len(batches)} batches ({2 * len(batches)} model calls).")
+    print(f"Estimated tokens: {sum(cost[0] for cost in costs):,} prompt, {sum(cost[1] for cost in costs):,} response.")
+    if args.backend == "gemini" and "API_KEY" not in os.environ:
+        print("Warning: API_KEY is not set; the gemini backend needs it.")
+
+# Function to write a representative's outputs to every pending file of its group and record each
+# file in the manifest. Returns the number of files that failed.
+def write_group_outputs(manifest, corpus, members, representative, detailed, analysis, prompt_hash):
+    failed_files = 0
+    for file_name in members:
+        fields = {"prompt_hash": prompt_hash}
+        if file_name != representative:
+            fields["representative"] = representative
+
+        # Files the model never answered are left for the next run
+        if detailed is None:
+            failed_files += 1
+            manifest.record(file_name, "failed", error="missing section in response", **fields)
+            continue
+
+        write_output(OUTPUT_FOLDER, file_name, detailed)
+        outputs = {"detailed": file_checksum(os.path.join(OUTPUT_FOLDER, file_name))}
+
+        if analysis is not None:
+            write_output(KEYWORDS_FOLDER, file_name, analysis)
+            outputs["keywords"] = file_checksum(os.path.join(KEYWORDS_FOLDER, file_name))
+
+        status = "done" if "keywords" in outputs else "failed"
+        failed_files += status == "failed"
+        manifest.record(file_name, status, input_hash=text_hash(corpus.read(file_name)), outputs=outputs, **fields)
+        print(f"Processed: {file_name}")
+    return failed_files
+
+# Function to parse command-line options
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate CPIR-MR detailed findings and CPMK-E keywords with Gemini.")
+    parser.add_argument("--backend", choices=["gemini", "fake"], default="gemini", help="LLM backend; 'fake' answers locally for offline load tests")
+    parser.add_argument("--fake-latency", type=float, default=0.5, help="Mean seconds per call of the fake backend")
+    parser.add_argument("--fake-error-rate", type=float, default=0.0, help="Probability a fake backend call fails")
+    parser.add_argument("--fake-drop-rate", type=float, default=0.0, help="Probability the fake backend leaves out a section")
+    parser.add_argument("--fake-seed", type=int, default=None, help="Seed for the fake backend, to replay a run exactly")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Maximum number of model calls in flight")
+    parser.add_argument("--requests-per-minute", type=float, default=REQUESTS_PER_MINUTE, help="Rate limit for model calls (0 disables it)")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE, help="Maximum number of findings per request")
+    parser.add_argument("--prompt-token-budget", type=int, default=PROMPT_TOKEN_BUDGET, help="Estimated prompt tokens allowed per request")
+    parser.add_argument("--response-token-budget", type=int, default=RESPONSE_TOKEN_BUDGET, help="Estimated response tokens allowed per request")
+    parser.add_argument("--input", default=INPUT_FOLDER, help="Findings folder, zip archive (optionally archive.zip:subfolder) or JSONL/Parquet corpus")
+    parser.add_argument("--manifest", default=MANIFEST_PATH, help="Append-only JSONL journal used to resume interrupted runs")
+    parser.add_argument("--restart", action="store_true", help="Ignore the manifest and reprocess every file")
+    parser.add_argument("--cache-mode", choices=CACHE_MODES, default="read-write", help="How the on-disk response cache is used")
+    parser.add_argument("--cache-path", default=CACHE_PATH, help="SQLite file holding cached model responses")
+    parser.add_argument("--cache-max-entries", type=int, default=100000, help="Evict least recently used responses beyond this count")
+    parser.add_argument("--trace", default=None, help="Append per-batch and per-call spans to this JSONL file")
+    parser.add_argument("--trace-otel", default=None, help="Also export the spans as an OpenTelemetry (OTLP/JSON) trace file")
+    parser.add_argument("--cache-max-age-days", type=float, default=None, help="Evict responses older than this many days")
+    parser.add_argument("--dedup", choices=DEDUP_MODES, default="exact",
+                        help="Send one finding per group of duplicates and copy its outputs to the others: exact (normalized text) or near (also reordered sentences and filler words)")
+    parser.add_argument("--dedup-report", default=DEDUP_REPORT_PATH, help="JSON mapping of every file to the representative whose outputs it received")
+    parser.add_argument("--dry-run", action="store_true", help="Report the pending files, batches and estimated tokens without calling the model")
+    return parser.parse_args()
+
 # Main function to orchestrate the entire process
 def main():
+    args = parse_args()
+    if args.dry_run:
+        dry_run(args)
+        return
+
     # Configure the AI model
-    genai.configure(api_key=os.environ["API_KEY"])
-    model = genai.GenerativeModel("gemini-1.5-flash")
+    if args.backend == "fake":
+        backend = FakeBackend(latency=args.fake_latency, error_rate=args.fake_error_rate,
+                              drop_rate=args.fake_drop_rate, seed=args.fake_seed)
+    else:
+        backend = GeminiBackend(MODEL_NAME, api_key=os.environ["API_KEY"])
+    model = backend
+
+    # Keep every model call, retries included, under the API quota; cache hits below take no token
+    if args.requests_per_minute:
+        model = RateLimitedModel(model, TokenBucket(args.requests_per_minute / 60.0, capacity=args.concurrency))
+
+    # Serve repeated prompts from the on-disk response cache; only complete responses are stored
+    cache = None
+    if args.cache_mode != "bypass":
+        cache = ResponseCache(args.cache_path, args.cache_max_entries, args.cache_max_age_days)
+    model = CachedModel(model, cache, backend.name, mode=args.cache_mode, validate=complete_response)
     
     # Set up the necessary folders
     setup_folders()
     
-    # Get the list of input files
-    input_files = get_input_files()
-    total_files = len(input_files)
-    
-    # Process files in batches
-    for i in tqdm(range(0, total_files, BATCH_SIZE), desc="Processing batches"):
-        batch_files = input_files[i:i+BATCH_SIZE]
-        extracted_sections, analysis_sections = process_batch(model, batch_files)
-        
-        # Write the results to output files
-        for j, (file_name, section) in enumerate(zip(batch_files, extracted_sections[1:]), 1):
-            write_output(OUTPUT_FOLDER, file_name, section)
-            
-            if j < len(analysis_sections):
-                write_output(KEYWORDS_FOLDER, file_name, analysis_sections[j])
-            
-            print(f"Processed: {file_name}")
-    
-    print("All files processed.")
+    # Get the list of input files, skipping those a previous run already completed
+    if args.restart and os.path.exists(args.manifest):
+        os.remove(args.manifest)
+    manifest = RunManifest(args.manifest)
+    # The spans and the journal are flushed even when the run is interrupted by an error
+    tracer = Tracer(args.trace, args.trace_otel)
+    corpus = None
+    try:
+        corpus = Corpus(args.input)
+        all_files = get_input_files(corpus)
+        input_files = get_pending_files(all_files, manifest, corpus)
+        total_files = len(input_files)
+
+        # Send one representative per group of duplicate findings and record who got whose outputs
+        groups, assignments = plan_dedup(corpus, all_files, input_files, args.dedup)
+        if args.dedup != "off":
+            write_mapping_report(args.dedup_report, assignments, args.dedup)
+
+        # Groups whose representative completed in an earlier run reuse its outputs without a model call
+        failed_files = reused_files = 0
+        pending = set(input_files)
+        for representative in [file for file in groups if file not in pending]:
+            reused_files += len(groups[representative])
+            detailed, analysis = read_outputs(representative)
+            prompt_hash = manifest.entries[representative].get("prompt_hash")
+            failed_files += write_group_outputs(manifest, corpus, groups.pop(representative), representative, detailed, analysis, prompt_hash)
+        representatives = list(groups)
+
+        # Pack the representatives into batches that fit the token budgets
+        texts = [corpus.read(file) for file in representatives]
+        batches = plan_batches(representatives, texts, args.prompt_token_budget, args.response_token_budget, args.max_batch_size)
+        print(f"{total_files} files to process: {reused_files} reused earlier outputs, {len(representatives)} distinct findings in {len(batches)} batches.")
+
+        # Process files in batches, recording a span per batch stage, model call and output write
+        started = time.perf_counter()
+        with tracer.span("run", files=total_files, representatives=len(representatives), batches=len(batches)):
+            results = process_batches(model, corpus, batches, args.concurrency, tracer)
+            for batch_files, result in tqdm(results, total=len(batches), desc="Processing batches"):
+                # Record the whole batch as failed so the next run regroups it
+                if isinstance(result, Exception):
+                    print(f"Batch starting at {batch_files[0]} failed: {result}")
+                    for file_name in batch_files:
+                        for member in groups[file_name]:
+                            failed_files += 1
+                            manifest.record(member, "failed", error=str(result))
+                    continue
+
+                texts, detailed_findings, analyses = result
+                prompt_hash = text_hash(generate_prompt(texts))
+
+                # Write the results to output files, fanning each one out to the duplicates of its file
+                with tracer.span("write_outputs", files=sum(len(groups[file_name]) for file_name in batch_files)):
+                    for file_name, detailed, analysis in zip(batch_files, detailed_findings, analyses):
+                        failed_files += write_group_outputs(manifest, corpus, groups[file_name], file_name, detailed, analysis, prompt_hash)
+    finally:
+        manifest.close()
+        if corpus is not None:
+            corpus.close()
+        tracer.close()
+
+    # Report model throughput and latency
+    elapsed = time.perf_counter() - started
+    stats = backend.latency_summary()
+    if stats["calls"]:
+        print(f"{stats['calls']} model calls ({stats['errors']} errors) in {elapsed:.1f}s: "
+              f"{stats['calls'] / elapsed:.2f} req/s, p50 {stats['p50']:.2f}s, p95 {stats['p95']:.2f}s, p99 {stats['p99']:.2f}s")
+
+    # Report where the wall-clock time went
+    tracer.print_summary()
+
+    if cache is not None:
+        print(f"Response cache: {model.hits} hits, {model.misses} model calls.")
+        if args.cache_mode == "read-write":
+            cache.evict()
+        cache.close()
+
+    if failed_files:
+        print(f"{failed_files} files failed; rerun to retry them.")
+    else:
+        print("All files processed.")
 
 # Entry point of the script
 if __name__ == "__main__":
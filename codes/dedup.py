@@ -0,0 +1,85 @@
+import os
+import re
+import json
+import hashlib
+
+# Words that do not change the meaning of a finding; near duplicates may only differ in these.
+# Negations, findings, sides and severities are deliberately absent.
+FILLER_WORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "been", "there", "this", "these", "that",
+    "of", "in", "on", "at", "to", "with", "as", "its", "also", "again",
+    "noted", "seen", "identified", "demonstrated", "visualized", "appear", "appears", "present",
+}
+DEDUP_MODES = ["off", "exact", "near"]
+
+# Function to normalize a finding for exact duplicate detection: lower case, whitespace and punctuation
+# collapsed, except the sentence boundaries ("." and ";"), which can change what a finding says:
+# "No pneumothorax, effusion." and "No pneumothorax. Effusion." stay different.
+def normalize_text(text):
+    sentences = [" ".join(re.sub(r"[^a-z0-9]+", " ", sentence).split()) for sentence in re.split(r"[.;]+", text.lower())]
+    return " . ".join(sentence for sentence in sentences if sentence)
+
+# Function to reduce a finding to its content: each sentence's words without FILLER_WORDS, in order,
+# with the sentences sorted. "The lungs are clear. Heart size is normal." and "Heart size normal.
+# Lungs clear." share one form, while a dropped or added word of substance, or a negation moved to
+# another sentence, gives a different one.
+def content_form(text):
+    sentences = []
+    for sentence in re.split(r"[.;\n]+", text.lower()):
+        words = [word for word in re.sub(r"[^a-z0-9]+", " ", sentence).split() if word not in FILLER_WORDS]
+        if words:
+            sentences.append(" ".join(words))
+    return " . ".join(sorted(sentences))
+
+# Function to hash a normalized form into the key findings are grouped by
+def dedup_key(form):
+    return hashlib.sha256(form.encode("utf-8")).hexdigest()
+
+# Function to group duplicate findings. mode "exact" groups findings whose normalized text is identical;
+# "near" also groups findings with the same content_form (reordered sentences, filler words).
+# Files are visited in the given order and the first file of a group is its representative.
+# Returns {file: (representative, match)} with match "self", "exact" or "near".
+def group_duplicates(files, texts, mode="exact"):
+    assignments = {}
+    exact_representatives = {}
+    near_representatives = {}
+    for file, text in zip(files, texts):
+        if mode == "off":
+            assignments[file] = (file, "self")
+            continue
+
+        exact = dedup_key(normalize_text(text))
+        near = dedup_key(content_form(text)) if mode == "near" else None
+        if exact in exact_representatives:
+            assignments[file] = (exact_representatives[exact], "exact")
+        elif near in near_representatives:
+            assignments[file] = (near_representatives[near], "near")
+        else:
+            assignments[file] = (file, "self")
+            exact_representatives[exact] = file
+            if near is not None:
+                near_representatives[near] = file
+    return assignments
+
+# Function to list the members of every group, representative first
+def group_members(assignments):
+    groups = {}
+    for file, (representative, _) in assignments.items():
+        groups.setdefault(representative, []).append(file)
+    return groups
+
+# Function to write the dedup mapping report: which representative's outputs every file received
+def write_mapping_report(path, assignments, mode):
+    groups = group_members(assignments)
+    report = {
+        "mode": mode,
+        "files": len(assignments),
+        "representatives": len(groups),
+        "duplicate_groups": sum(1 for members in groups.values() if len(members) > 1),
+        "mapping": {file: {"representative": representative, "match": match}
+                    for file, (representative, match) in sorted(assignments.items())},
+    }
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2)
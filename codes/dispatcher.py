@@ -0,0 +1,94 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Token bucket used to keep model calls under the API quota
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        # rate is in tokens per second, capacity is the allowed burst size
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Block until the requested number of tokens is available
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_time = (tokens - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+# Wrapper around a model that takes a token before every generate_content call, so retries and
+# re-requested items count against the quota like any other call
+class RateLimitedModel:
+    def __init__(self, model, rate_limiter):
+        self.model = model
+        self.rate_limiter = rate_limiter
+
+    def generate_content(self, contents, stream=False):
+        self.rate_limiter.acquire()
+        return self.model.generate_content(contents, stream=stream)
+
+# Two-stage batch dispatcher: each batch runs first_stage (CPIR-MR) then second_stage (CPMK-E).
+# Up to max_in_flight model calls run at once, and the second stage of batch k is scheduled
+# as soon as its first stage is done, so it overlaps with the first stage of batch k+1.
+# With return_exceptions=True a failing batch yields its exception instead of aborting the run.
+# A stage may make several model calls, so rate limiting belongs on the model (RateLimitedModel).
+class BatchDispatcher:
+    def __init__(self, max_in_flight=4, return_exceptions=False):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.return_exceptions = return_exceptions
+
+    # Dispatch every batch and yield (batch, result) pairs in the original batch order
+    def run(self, batches, first_stage, second_stage):
+        batches = list(batches)
+        # Admit one extra batch so a first stage is always queued behind a running second stage
+        window = self.max_in_flight + 1
+        pending = {}
+        finished = {}
+        next_batch = 0
+        next_to_yield = 0
+        active = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            try:
+                while next_to_yield < len(batches):
+                    # Admit new batches while the window has room
+                    while active < window and next_batch < len(batches):
+                        future = executor.submit(first_stage, batches[next_batch])
+                        pending[future] = (next_batch, 1)
+                        next_batch += 1
+                        active += 1
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index, stage = pending.pop(future)
+                        error = future.exception()
+                        if error is not None:
+                            if not self.return_exceptions:
+                                raise error
+                            finished[index] = error
+                            active -= 1
+                            continue
+                        intermediate = future.result()
+                        if stage == 1:
+                            second = executor.submit(second_stage, batches[index], intermediate)
+                            pending[second] = (index, 2)
+                        else:
+                            finished[index] = intermediate
+                            active -= 1
+
+                    # Yield completed batches in order so outputs match a serial run
+                    while next_to_yield in finished:
+                        yield batches[next_to_yield], finished.pop(next_to_yield)
+                        next_to_yield += 1
+            finally:
+                for future in pending:
+                    future.cancel()
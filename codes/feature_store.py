@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Function to hash the raw bytes of an image file
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+# Append-only store of fixed-width float32 feature vectors keyed by image content hash.
+# Vectors live in a raw binary file read through np.memmap; keys.jsonl maps each
+# "<model_id>/<hash>" key to its row. Rows computed with other model ids stay on disk
+# until compact() drops them. A read_only store never creates or writes files.
+class FeatureStore:
+    def __init__(self, root, model_id, dim, columns=None, read_only=False):
+        if not read_only:
+            os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.model_id = model_id
+        self.dim = dim
+        self.data_path = os.path.join(root, "features.f32")
+        self.keys_path = os.path.join(root, "keys.jsonl")
+        self.meta_path = os.path.join(root, "meta.json")
+        self.rows = {}
+        self.view = None
+
+        meta = {}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+            if meta["dim"] != dim:
+                raise ValueError(f"Feature store {root} holds {meta['dim']}-d vectors, not {dim}-d")
+        self.columns = columns or meta.get("columns")
+        if not read_only:
+            self._write_meta()
+
+        # Only rows fully written to the data file are valid after a crash; a partial row left at the
+        # end is cut off so later appends stay aligned
+        written = os.path.getsize(self.data_path) // (4 * dim) if os.path.exists(self.data_path) else 0
+        if not read_only and os.path.exists(self.data_path) and os.path.getsize(self.data_path) != written * 4 * dim:
+            os.truncate(self.data_path, written * 4 * dim)
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, "r", encoding="utf-8") as keys_file:
+                for line in keys_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry["row"] < written:
+                        self.rows[entry["key"]] = entry["row"]
+        self.size = written
+
+    def _write_meta(self):
+        with open(self.meta_path, "w", encoding="utf-8") as meta_file:
+            json.dump({"dim": self.dim, "columns": self.columns}, meta_file)
+
+    def _key(self, image_hash):
+        return f"{self.model_id}/{image_hash}"
+
+    # Image hashes that already have a vector for the current model id
+    def known_hashes(self):
+        prefix = f"{self.model_id}/"
+        return {key[len(prefix):] for key in self.rows if key.startswith(prefix)}
+
+    def __contains__(self, image_hash):
+        return self._key(image_hash) in self.rows
+
+    # Return the stored vector for an image hash, or None
+    def get(self, image_hash):
+        row = self.rows.get(self._key(image_hash))
+        if row is None:
+            return None
+        if self.view is None or row >= len(self.view):
+            self.view = self._memmap()
+        return np.array(self.view[row])
+
+    # Map the complete rows of the data file; the shape never depends on trailing bytes
+    def _memmap(self):
+        return np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(self.size, self.dim))
+
+    # Append vectors of shape (N, dim) for the given image hashes
+    def put_many(self, image_hashes, vectors, columns=None):
+        if columns is not None and self.columns is None:
+            self.columns = list(columns)
+            self._write_meta()
+        self._append([self._key(image_hash) for image_hash in image_hashes], vectors)
+
+    def _append(self, keys, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with open(self.data_path, "ab") as data_file:
+            data_file.write(vectors.tobytes())
+        with open(self.keys_path, "a", encoding="utf-8") as keys_file:
+            for offset, key in enumerate(keys):
+                self.rows[key] = self.size + offset
+                keys_file.write(json.dumps({"key": key, "row": self.size + offset}) + "\n")
+        self.size += len(vectors)
+
+    # Append the rows of another store (of any model id) that this one lacks. Returns the number added.
+    def absorb(self, other):
+        keys = [key for key in sorted(other.rows, key=other.rows.get) if key not in self.rows]
+        if other.columns is not None and self.columns is None:
+            self.columns = list(other.columns)
+            self._write_meta()
+        if keys:
+            data = other._memmap()
+            vectors = np.asarray(data[[other.rows[key] for key in keys]], dtype=np.float32)
+            del data
+            self._append(keys, vectors)
+        return len(keys)
+
+    # Rewrite the store keeping only the latest row of each key for the current model id,
+    # optionally limited to the max_rows most recently appended ones
+    def compact(self, max_rows=None):
+        prefix = f"{self.model_id}/"
+        keep = sorted((row, key) for key, row in self.rows.items() if key.startswith(prefix))
+        if max_rows is not None:
+            keep = keep[-max_rows:]
+
+        data = self._memmap() if self.size else None
+        vectors = np.asarray(data[[row for row, _ in keep]], dtype=np.float32) if keep else np.zeros((0, self.dim), np.float32)
+        del data
+        self.view = None
+
+        # Write the compacted files next to the old ones, then swap them in
+        with open(self.data_path + ".tmp", "wb") as data_file:
+            data_file.write(vectors.tobytes())
+        with open(self.keys_path + ".tmp", "w", encoding="utf-8") as keys_file:
+            for new_row, (_, key) in enumerate(keep):
+                keys_file.write(json.dumps({"key": key, "row": new_row}) + "\n")
+        os.replace(self.data_path + ".tmp", self.data_path)
+        os.replace(self.keys_path + ".tmp", self.keys_path)
+
+        self.rows = {key: new_row for new_row, (_, key) in enumerate(keep)}
+        self.size = len(keep)
+
+# A shared store read by every shard, with this shard's new vectors appended to a store of its own.
+# Shards never write to the shared store, so they can run concurrently; merge_stores folds them back.
+class LayeredFeatureStore:
+    def __init__(self, shared, own):
+        self.shared = shared
+        self.own = own
+
+    @property
+    def columns(self):
+        return self.own.columns or self.shared.columns
+
+    def known_hashes(self):
+        return self.shared.known_hashes() | self.own.known_hashes()
+
+    def __contains__(self, image_hash):
+        return image_hash in self.own or image_hash in self.shared
+
+    def get(self, image_hash):
+        stored = self.own.get(image_hash)
+        return stored if stored is not None else self.shared.get(image_hash)
+
+    def put_many(self, image_hashes, vectors, columns=None):
+        self.own.put_many(image_hashes, vectors, columns=columns)
+
+    # Only the shard's own store is rewritten; the shared one is compacted after merging
+    def compact(self, max_rows=None):
+        self.own.compact(max_rows)
+
+# Function to fold the stores at shard_roots into the store at root, which is created if needed.
+# Vectors the shared store already holds are skipped. Returns the number of vectors added.
+def merge_stores(root, shard_roots):
+    added = 0
+    for shard_root in shard_roots:
+        with open(os.path.join(shard_root, "meta.json"), "r", encoding="utf-8") as meta_file:
+            dim = json.load(meta_file)["dim"]
+        store = FeatureStore(root, None, dim)
+        added += store.absorb(FeatureStore(shard_root, None, dim, read_only=True))
+    return added
@@ -0,0 +1,81 @@
+import json
+import os
+
+# Function to list the image files of a folder together with the folder's mtime
+def scan_folder(folder):
+    with os.scandir(folder) as entries:
+        files = sorted(entry.name for entry in entries if entry.is_file())
+    return {"mtime": os.stat(folder).st_mtime_ns, "files": files}
+
+# Function to map every base name to the sorted image files that start with "<base>_".
+# Each prefix ending before an underscore is indexed, so lookups agree with a startswith scan.
+def build_prefix_map(files):
+    prefix_map = {}
+    for file_name in files:
+        position = file_name.find("_")
+        while position != -1:
+            prefix_map.setdefault(file_name[:position], []).append(file_name)
+            position = file_name.find("_", position + 1)
+    return prefix_map
+
+# Persistent index of the frontal and lateral image folders.
+# A folder is only listed again when its mtime changed since the index was saved.
+class ImageIndex:
+    def __init__(self, folders, index_path=None):
+        self.folders = folders
+        self.index_path = index_path
+        self.listings = {}
+        self.prefix_maps = {}
+        self.refreshed = []
+
+        saved = {}
+        if index_path and os.path.exists(index_path):
+            with open(index_path, "r", encoding="utf-8") as index_file:
+                saved = json.load(index_file)
+
+        for folder in folders:
+            key = os.path.abspath(folder)
+            listing = saved.get(key)
+            if listing is None or listing["mtime"] != os.stat(folder).st_mtime_ns:
+                listing = scan_folder(folder)
+                self.refreshed.append(folder)
+            self.listings[key] = listing
+            self.prefix_maps[key] = build_prefix_map(listing["files"])
+
+        if index_path and self.refreshed:
+            self.save()
+
+    # Write to a temporary file first so concurrent shards never see a half-written index
+    def save(self):
+        temporary_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as index_file:
+            json.dump(self.listings, index_file)
+        os.replace(temporary_path, self.index_path)
+
+    # Sorted image files in a folder that belong to a report base name
+    def lookup(self, folder, base_name):
+        return self.prefix_maps[os.path.abspath(folder)].get(base_name, [])
+
+    # Pair reports with their frontal and lateral images.
+    # Returns the matched (txt_file, frontal_path, lateral_path) triples, the reports missing
+    # a view, and the images whose base name has no report.
+    def match_reports(self, txt_files, frontal_folder, lateral_folder):
+        matched, unmatched_reports, used_images = [], [], set()
+        for txt_file in txt_files:
+            base_name = os.path.splitext(txt_file)[0]
+            frontal = self.lookup(frontal_folder, base_name)
+            lateral = self.lookup(lateral_folder, base_name)
+            if frontal and lateral:
+                matched.append((txt_file, os.path.join(frontal_folder, frontal[0]), os.path.join(lateral_folder, lateral[0])))
+            else:
+                unmatched_reports.append(txt_file)
+            used_images.update(os.path.join(frontal_folder, name) for name in frontal)
+            used_images.update(os.path.join(lateral_folder, name) for name in lateral)
+
+        unmatched_images = [
+            os.path.join(folder, name)
+            for folder in (frontal_folder, lateral_folder)
+            for name in self.listings[os.path.abspath(folder)]["files"]
+            if os.path.join(folder, name) not in used_images
+        ]
+        return matched, unmatched_reports, unmatched_images
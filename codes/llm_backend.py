@@ -0,0 +1,214 @@
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_planner import estimate_tokens, ordinal
+
+# Chunk of a model response, shaped like the objects the Gemini SDK returns. usage holds the
+# {"prompt_tokens", "response_tokens"} counts the provider reported, or None when it reports none.
+class TextChunk:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.usage = usage
+
+    def __iter__(self):
+        yield self
+
+# Function to wrap response text in a TextChunk, leaving chunks that carry usage as they are
+def as_chunk(piece):
+    return piece if isinstance(piece, TextChunk) else TextChunk(piece)
+
+# Function to read the token counts Gemini reports in a response's (or stream chunk's) usage_metadata.
+# Streamed chunks carry running totals, so the last chunk holds the counts of the whole call.
+def gemini_usage(response):
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is None or not getattr(metadata, "prompt_token_count", 0):
+        return None
+    return {"prompt_tokens": metadata.prompt_token_count, "response_tokens": getattr(metadata, "candidates_token_count", 0) or 0}
+
+# Function to flatten the prompt parts passed to generate_content into one string
+def join_contents(contents):
+    return contents if isinstance(contents, str) else "".join(contents)
+
+# Base class for LLM backends. Subclasses implement _generate and may override
+# _stream and count_tokens; generate_content keeps the Gemini-style call used by the pipeline.
+# _generate and _stream return text, or TextChunks when the provider reports token usage.
+class LLMBackend:
+    name = "backend"
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.stats_lock = threading.Lock()
+
+    def _generate(self, contents):
+        raise NotImplementedError
+
+    def _stream(self, contents):
+        yield self._generate(contents)
+
+    # Return the full response text for a prompt
+    def generate(self, contents):
+        return self.generate_chunk(contents).text
+
+    # Return the full response as a TextChunk, with the provider's token usage when reported
+    def generate_chunk(self, contents):
+        start = time.perf_counter()
+        try:
+            result = self._generate(contents)
+        except Exception:
+            self._record(None)
+            raise
+        self._record(time.perf_counter() - start)
+        return as_chunk(result)
+
+    # Yield the response text piece by piece; latency is measured until the last piece
+    def stream(self, contents):
+        for chunk in self.stream_chunks(contents):
+            yield chunk.text
+
+    # Yield the response as TextChunks, with the provider's token usage when reported
+    def stream_chunks(self, contents):
+        start = time.perf_counter()
+        try:
+            for piece in self._stream(contents):
+                yield as_chunk(piece)
+        except GeneratorExit:
+            raise
+        except Exception:
+            self._record(None)
+            raise
+        self._record(time.perf_counter() - start)
+
+    # Estimate the number of prompt tokens
+    def count_tokens(self, contents):
+        return estimate_tokens(join_contents(contents))
+
+    # Generate responses for several prompts at once
+    def submit_batch(self, requests, max_workers=4):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.generate, requests))
+
+    # Gemini-style entry point used by cpir-mr.py and CachedModel
+    def generate_content(self, contents, stream=False):
+        if stream:
+            return self.stream_chunks(contents)
+        return self.generate_chunk(contents)
+
+    def _record(self, latency):
+        with self.stats_lock:
+            if latency is None:
+                self.errors += 1
+            else:
+                self.latencies.append(latency)
+
+    # Summarise the calls made so far: count, errors and latency percentiles in seconds
+    def latency_summary(self):
+        with self.stats_lock:
+            latencies = sorted(self.latencies)
+            errors = self.errors
+        if not latencies:
+            return {"calls": 0, "errors": errors}
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))]
+
+        return {
+            "calls": len(latencies),
+            "errors": errors,
+            "mean": sum(latencies) / len(latencies),
+            "p50": percentile(50),
+            "p95": percentile(95),
+            "p99": percentile(99),
+            "max": latencies[-1],
+        }
+
+# Adapter for the Google Generative AI SDK
+class GeminiBackend(LLMBackend):
+    def __init__(self, model_name, api_key, generation_config=None):
+        super().__init__()
+        import google.generativeai as genai
+
+        genai.configure(api_key=api_key)
+        self.name = model_name
+        self.model = genai.GenerativeModel(model_name, generation_config=generation_config)
+
+    def _generate(self, contents):
+        response = self.model.generate_content(contents)
+        return TextChunk(response.text, gemini_usage(response))
+
+    def _stream(self, contents):
+        for chunk in self.model.generate_content(contents, stream=True):
+            yield TextChunk(chunk.text, gemini_usage(chunk))
+
+    def count_tokens(self, contents):
+        return self.model.count_tokens(contents).total_tokens
+
+# Error raised by the fake backend to simulate API failures
+class FakeBackendError(RuntimeError):
+    pass
+
+# Deterministic in-process stand-in for the Gemini API, used for offline load testing.
+# It recognises the CPIR-MR and CPMK-E prompts and answers in the format the parser expects.
+class FakeBackend(LLMBackend):
+    name = "fake"
+
+    def __init__(self, latency=0.5, jitter=0.2, error_rate=0.0, drop_rate=0.0, lines=7, chunk_size=64, seed=None):
+        super().__init__()
+        self.latency = latency  # Mean seconds per call
+        self.jitter = jitter  # Relative spread of the latency
+        self.error_rate = error_rate  # Probability a call raises FakeBackendError
+        self.drop_rate = drop_rate  # Probability each section is left out of a response
+        self.lines = lines  # Sentences per detailed finding
+        self.chunk_size = chunk_size  # Characters per streamed chunk
+        self.seed = seed if seed is not None else random.randrange(2**32)  # Fix it to replay a run exactly
+        self.attempts = {}
+
+    # Seed a generator from the prompt and how often it was sent, so runs are reproducible
+    # while a retried prompt can still succeed after a simulated failure
+    def _rng(self, prompt):
+        with self.stats_lock:
+            attempt = self.attempts.get(prompt, 0)
+            self.attempts[prompt] = attempt + 1
+        return random.Random(f"{self.seed}:{attempt}:{prompt}")
+
+    def _respond(self, contents):
+        prompt = join_contents(contents)
+        rng = self._rng(prompt)
+        if self.latency:
+            time.sleep(max(0.0, rng.gauss(self.latency, self.latency * self.jitter)))
+        if rng.random() < self.error_rate:
+            raise FakeBackendError("simulated API failure")
+
+        detailed = re.search(r"I have (\d+) examples", prompt)
+        if detailed:
+            sections = []
+            for i in range(1, int(detailed.group(1)) + 1):
+                if rng.random() < self.drop_rate:
+                    continue
+                body = " ".join(f"Sentence {j} explaining finding {i} in plain language." for j in range(1, self.lines + 1))
+                sections.append(f"\n\n**{i}. {ordinal(i)}:** {body}")
+            return "Here are the detailed findings:" + "".join(sections)
+
+        pairs = len(re.findall(r"^Original \d+:", prompt, flags=re.M))
+        sections = []
+        for i in range(1, pairs + 1):
+            if rng.random() < self.drop_rate:
+                continue
+            sections.append(
+                f"**Pair {i}:**\n\n1. **Original Keywords:** lungs, heart, clear, normal, size\n"
+                f"2. **Detailed Keywords:** lungs, heart, healthy, normal, shape\n"
+                f"3. **Similarity Rating:** {rng.randint(6, 10)}\n"
+                f"4. **Explanation:** The detailed finding restates the original in plain language.\n\n"
+            )
+        return "".join(sections)
+
+    def _generate(self, contents):
+        return self._respond(contents)
+
+    def _stream(self, contents):
+        text = self._respond(contents)
+        for start in range(0, len(text), self.chunk_size):
+            yield text[start:start + self.chunk_size]
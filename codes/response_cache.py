@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_MODES = ("read-write", "read-only", "bypass")
+
+# Function to build the content-addressed key for a model call
+def cache_key(model_name, contents, generation_config=None):
+    payload = json.dumps({
+        "model": model_name,
+        "contents": contents if isinstance(contents, str) else list(contents),
+        "generation_config": generation_config or {},
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# On-disk SQLite cache of model responses with size- and age-based eviction
+class ResponseCache:
+    def __init__(self, path, max_entries=100000, max_age_days=None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, text TEXT, created REAL, accessed REAL)"
+        )
+        self.conn.commit()
+
+    # Return the cached response text, or None on a miss or an expired entry
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT text, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            text, created = row
+            if self.max_age is not None and now - created > self.max_age:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            return text
+
+    # Store a response text under its key
+    def put(self, key, model_name, text):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, text, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, model_name, text, now, now),
+            )
+            self.conn.commit()
+
+    # Remove a stored response, e.g. one the caller found to be incomplete
+    def invalidate(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.conn.commit()
+
+    # Drop expired entries, then the least recently used ones above max_entries
+    def evict(self):
+        with self.lock:
+            if self.max_age is not None:
+                self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+            if self.max_entries is not None:
+                self.conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# Minimal response object exposing the .text attribute used by the pipeline
+class CachedResponse:
+    def __init__(self, text):
+        self.text = text
+
+    # A cached response streams as a single chunk
+    def __iter__(self):
+        yield self
+
+# Wrapper around a model that serves generate_content from the cache when possible.
+# validate(contents, text) decides whether a response is complete: only complete responses are
+# stored, and a cached response that fails it is dropped and requested again.
+class CachedModel:
+    def __init__(self, model, cache, model_name, generation_config=None, mode="read-write", validate=None):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode: {mode}")
+        self.model = model
+        self.cache = cache
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self.mode = mode
+        self.validate = validate
+        self.hits = 0
+        self.misses = 0
+        self.stats_lock = threading.Lock()
+
+    def generate_content(self, contents, stream=False):
+        if self.mode == "bypass":
+            return self.model.generate_content(contents, stream=stream)
+
+        key = self.key(contents)
+        text = self.cache.get(key)
+        if text is not None and not self._is_complete(contents, text):
+            if self.mode == "read-write":
+                self.cache.invalidate(key)
+            text = None
+        if text is not None:
+            with self.stats_lock:
+                self.hits += 1
+            return CachedResponse(text)
+
+        with self.stats_lock:
+            self.misses += 1
+        result = self.model.generate_content(contents, stream=stream)
+        if self.mode != "read-write":
+            return result
+        if stream:
+            return self._store_when_complete(key, contents, result)
+        self._store(key, contents, result.text)
+        return result
+
+    # Cache key of a prompt sent through this model
+    def key(self, contents):
+        return cache_key(self.model_name, contents, self.generation_config)
+
+    # Drop the cached response to a prompt, so the next call reaches the model
+    def invalidate(self, contents):
+        if self.cache is not None:
+            self.cache.invalidate(self.key(contents))
+
+    def _is_complete(self, contents, text):
+        return self.validate is None or self.validate(contents, text)
+
+    def _store(self, key, contents, text):
+        if self._is_complete(contents, text):
+            self.cache.put(key, self.model_name, text)
+
+    # Pass streamed chunks through and cache the full text once the stream is exhausted
+    def _store_when_complete(self, key, contents, result):
+        parts = []
+        for chunk in result:
+            parts.append(chunk.text)
+            yield chunk
+        self._store(key, contents, "".join(parts))
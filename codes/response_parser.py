@@ -0,0 +1,136 @@
+import math
+import re
+
+from batch_planner import ordinal
+
+# Header of a CPIR-MR section, e.g. "**3. THIRD:**" (the bold markers are optional)
+SECTION_HEADER = re.compile(r'(?:^|\n)[ \t]*(?:\*\*)?(\d+)\.[ \t]+([A-Z][A-Z -]*?(?:ST|ND|RD|TH)):(?:\*\*)?[ \t]*')
+# Header of a CPMK-E pair analysis, e.g. "Pair 3:" or "**Pair 3:**"
+PAIR_HEADER = re.compile(r'(?:\*\*)?Pair (\d+)\b')
+
+# Incremental parser for numbered sections in a (possibly streamed) model response.
+# A section is complete once the next header has arrived, so sections are emitted as
+# the stream progresses and the last one is emitted on close().
+class SectionStreamParser:
+    def __init__(self, expected, header=SECTION_HEADER):
+        self.expected = expected
+        self.header = header
+        self.buffer = ""
+        self.open_header = None  # (number, label, content start) of the section being received
+        self.search_from = 0
+        self.sections = {}
+        self.problems = []
+
+    # Feed a chunk of response text and return the sections completed by it
+    def feed(self, chunk):
+        self.buffer += chunk
+        return self._scan(final=False)
+
+    # Finish the stream and return the remaining sections
+    def close(self):
+        completed = self._scan(final=True)
+        if self.open_header is not None:
+            completed.extend(self._close(len(self.buffer)))
+        return completed
+
+    # Look for new headers; each one completes the section opened by the previous header
+    def _scan(self, final):
+        completed = []
+        # Rescan a little before the old end of the buffer so a header split across chunks is found
+        start = max(self.search_from - 64, 0)
+        if self.open_header is not None:
+            start = max(start, self.open_header[2])
+        for match in self.header.finditer(self.buffer, start):
+            # A header at the very end of the buffer may still be growing (e.g. its closing "**")
+            if match.end() >= len(self.buffer) - 2 and not final:
+                break
+            if self.open_header is not None:
+                completed.extend(self._close(match.start()))
+            label = match.group(2) if self.header.groups >= 2 else None
+            self.open_header = (int(match.group(1)), label, match.end())
+        self.search_from = len(self.buffer)
+        return completed
+
+    # Validate the open section and store it under its number
+    def _close(self, end):
+        number, label, content_start = self.open_header
+        self.open_header = None
+        content = self.buffer[content_start:end]
+        if number < 1 or number > self.expected:
+            self.problems.append(f"section {number} is out of range 1-{self.expected}")
+            return []
+        if label is not None and not f"{label.strip()} ".startswith(f"{ordinal(number)} "):
+            self.problems.append(f"section {number} is labelled {label.strip()}")
+            return []
+        if number in self.sections:
+            self.problems.append(f"section {number} appears more than once")
+            return []
+        self.sections[number] = content
+        return [(number, content)]
+
+    # Positions (1-based) of the inputs that did not get a valid section
+    def missing(self):
+        return [i for i in range(1, self.expected + 1) if i not in self.sections]
+
+# Function to yield the text of a model response chunk by chunk
+def iter_response_text(response):
+    if isinstance(response, str):
+        yield response
+        return
+    try:
+        chunks = iter(response)
+    except TypeError:
+        yield response.text
+        return
+    for chunk in chunks:
+        yield chunk.text
+
+# Function to parse a CPIR-MR response into {position: detailed finding}
+def parse_detailed_sections(response, expected):
+    parser = SectionStreamParser(expected)
+    for chunk in iter_response_text(response):
+        parser.feed(chunk)
+    parser.close()
+    return {number: content.strip() for number, content in parser.sections.items()}, parser
+
+# Function to parse a CPMK-E response into {position: pair analysis}.
+# The stored text starts at the pair number, matching the historical split on "Pair ".
+def parse_pair_sections(response, expected):
+    parser = SectionStreamParser(expected, header=PAIR_HEADER)
+    for chunk in iter_response_text(response):
+        parser.feed(chunk)
+    parser.close()
+    return {number: f"{number}{content}" for number, content in parser.sections.items()}, parser
+
+# Function to request a batch and re-request only the items that did not come back.
+# request(items) must return {position: output} for 1-based positions within items.
+# Unmatched items are retried together up to max_retries times. A batch with no usable output is
+# bisected instead, down to single items: max_splits bounds the bisection depth separately from
+# the retries and defaults to ceil(log2(len(items))).
+def request_with_retry(request, items, max_retries=3, max_splits=None):
+    if max_splits is None:
+        max_splits = math.ceil(math.log2(len(items))) if len(items) > 1 else 0
+    results = [None] * len(items)
+    parsed = request(items)
+    for position, output in parsed.items():
+        results[position - 1] = output
+
+    missing = [i for i, output in enumerate(results) if output is None]
+    if not missing:
+        return results
+
+    if len(missing) == len(items) and len(items) > 1 and max_splits > 0:
+        # Nothing matched: the batch itself is the problem, so bisect it
+        middle = len(missing) // 2
+        groups = [missing[:middle], missing[middle:]]
+        retries, splits = max_retries, max_splits - 1
+    elif max_retries > 0:
+        groups = [missing]
+        retries, splits = max_retries - 1, max_splits
+    else:
+        return results
+    for group in groups:
+        retried = request_with_retry(request, [items[i] for i in group], retries, splits)
+        for i, output in zip(group, retried):
+            results[i] = output
+    return results
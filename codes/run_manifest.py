@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+import time
+
+# Function to hash a piece of text for the manifest
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# Function to checksum a file on disk, or None if it does not exist
+def file_checksum(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+# Append-only JSONL journal recording the status of every input file in a run.
+# The last record for a file wins, so a restart only needs to replay the journal.
+# A read-only manifest replays the journal without creating or appending to it.
+class RunManifest:
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as journal:
+                for line in journal:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash mid-write can leave a truncated last line
+                        continue
+                    self.entries[record["file"]] = record
+        self.journal = None
+        if read_only:
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.journal = open(path, "a", encoding="utf-8")
+
+    # Append a record and flush it so it survives a crash
+    def record(self, file_name, status, **fields):
+        entry = {"file": file_name, "status": status, "time": time.time(), **fields}
+        self.entries[file_name] = entry
+        self.journal.write(json.dumps(entry, sort_keys=True) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    # Check whether a file finished with the same input and its outputs are still intact
+    def is_complete(self, file_name, input_hash, output_paths):
+        entry = self.entries.get(file_name)
+        if entry is None or entry["status"] != "done" or entry.get("input_hash") != input_hash:
+            return False
+        checksums = entry.get("outputs", {})
+        return all(checksums.get(key) is not None and file_checksum(path) == checksums[key]
+                   for key, path in output_paths.items())
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# One timed operation of a run. Attributes hold sizes, counts and other details of the operation;
+# numeric attributes are summed per span name in the run summary.
+class Span:
+    def __init__(self, trace_id, name, parent, attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.name = name
+        self.attributes = dict(attributes)
+        self.start_ns = time.time_ns()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    # Add to numeric attributes, e.g. bytes received over several chunks
+    def add(self, **amounts):
+        for key, amount in amounts.items():
+            self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": self.duration * 1000,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+# Records the spans of one run. Finished spans are kept for the summary, appended to a JSONL
+# file when path is given, and exported as OpenTelemetry (OTLP/JSON) on close() when otel_path is given.
+# A span opened without an explicit parent nests under the innermost open span of the same thread.
+class Tracer:
+    def __init__(self, path=None, otel_path=None, service_name="cpir-mr"):
+        self.trace_id = os.urandom(16).hex()
+        self.otel_path = otel_path
+        self.service_name = service_name
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.file = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = open(path, "a", encoding="utf-8")
+
+    def current(self):
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name, parent=None, **attributes):
+        span = Span(self.trace_id, name, parent if parent is not None else self.current(), attributes)
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            span.duration = time.perf_counter() - span.started
+            self._finish(span)
+
+    def _finish(self, span):
+        with self.lock:
+            self.spans.append(span)
+            if self.file is not None:
+                self.file.write(json.dumps(span.to_dict()) + "\n")
+                self.file.flush()
+
+    # Per span name: count, errors, total/mean/p50/p95 seconds and the sums of numeric attributes
+    def summary(self):
+        with self.lock:
+            spans = list(self.spans)
+        groups = {}
+        for span in spans:
+            groups.setdefault(span.name, []).append(span)
+
+        summary = {}
+        for name, group in groups.items():
+            durations = sorted(span.duration for span in group)
+
+            def percentile(p):
+                return durations[min(len(durations) - 1, int(round(p / 100 * (len(durations) - 1))))]
+
+            totals = {}
+            for span in group:
+                for key, value in span.attributes.items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        totals[key] = totals.get(key, 0) + value
+            summary[name] = {
+                "count": len(group),
+                "errors": sum(1 for span in group if span.error),
+                "total": sum(durations),
+                "mean": sum(durations) / len(durations),
+                "p50": percentile(50),
+                "p95": percentile(95),
+                "totals": totals,
+            }
+        return summary
+
+    # Print the summary as a table, followed by the attribute totals of each span name
+    def print_summary(self):
+        summary = self.summary()
+        if not summary:
+            return
+        print(f"{'span':<16}{'count':>7}{'errors':>8}{'total s':>10}{'mean s':>9}{'p50 s':>9}{'p95 s':>9}")
+        for name, stats in summary.items():
+            print(f"{name:<16}{stats['count']:>7}{stats['errors']:>8}{stats['total']:>10.2f}{stats['mean']:>9.3f}{stats['p50']:>9.3f}{stats['p95']:>9.3f}")
+        for name, stats in summary.items():
+            if stats["totals"]:
+                totals = ", ".join(f"{key}={value:,.0f}" if float(value).is_integer() else f"{key}={value:,.2f}"
+                                   for key, value in sorted(stats["totals"].items()))
+                print(f"  {name}: {totals}")
+
+    # Write the recorded spans as an OTLP/JSON trace, loadable by OpenTelemetry collectors and viewers
+    def export_otel(self, path):
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            if isinstance(value, float):
+                return {"key": key, "value": {"doubleValue": value}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        with self.lock:
+            spans = list(self.spans)
+        otel_spans = []
+        for span in spans:
+            otel_span = {
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.start_ns + int(span.duration * 1e9)),
+                "attributes": [attribute(key, value) for key, value in span.attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+            }
+            if span.parent_id:
+                otel_span["parentSpanId"] = span.parent_id
+            otel_spans.append(otel_span)
+
+        trace = {"resourceSpans": [{
+            "resource": {"attributes": [attribute("service.name", self.service_name)]},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": otel_spans}],
+        }]}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(trace, f)
+
+    def close(self):
+        if self.otel_path:
+            self.export_otel(self.otel_path)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+# Function to pass a streamed model response through while recording on span how long was spent
+# waiting for each chunk, how much text arrived and the token counts the provider reported
+def trace_stream(response, span):
+    chunks = iter(response)
+    while True:
+        started = time.perf_counter()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            span.add(wait_s=time.perf_counter() - started)
+            return
+        span.add(wait_s=time.perf_counter() - started, chunks=1, response_chars=len(chunk.text))
+        # Token counts reported by the provider are running totals; keep the latest
+        usage = getattr(chunk, "usage", None)
+        if usage:
+            span.set(**usage)
+        yield chunk
@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+MEDICAL_TERMS = ['cancer', 'tumor', 'lesion', 'fracture', 'inflammation']
+# Per-text scores returned by score_text, in order
+SCORE_NAMES = ['Flesch Reading Ease', 'Flesch-Kincaid Grade', 'Sentiment', 'Sentence Complexity']
+SCORE_COLUMNS = [f'{prefix} {name}' for prefix in ('Original', 'Detailed') for name in SCORE_NAMES]
+
+# Function definitions
+def extract_keywords(text):
+    match = re.search(r'Keywords: ([\w\s,]+)', text)
+    return [word.strip() for word in match.group(1).split(',')] if match else []
+
+def analyze_keyword_overlap(original_keywords, detailed_keywords):
+    original_set = set(original_keywords)
+    detailed_set = set(detailed_keywords)
+    overlap = original_set.intersection(detailed_set)
+    return len(overlap) / len(original_set) * 100 if original_set else 0
+
+def analyze_text_complexity(text):
+    import textstat
+
+    flesch_reading_ease = textstat.flesch_reading_ease(text)
+    flesch_kincaid_grade = textstat.flesch_kincaid_grade(text)
+    return flesch_reading_ease, flesch_kincaid_grade
+
+def get_sentiment(text):
+    from textblob import TextBlob
+
+    return TextBlob(text).sentiment.polarity
+
+def extract_similarity_score(text):
+    match = re.search(r'Similarity Rating: (\d+)', text)
+    return int(match.group(1)) if match else None
+
+def extract_medical_entities(text):
+    return [term for term in MEDICAL_TERMS if term in text.lower()]
+
+def analyze_sentence_structure(text):
+    import textstat
+
+    if not isinstance(text, str):
+        return 0
+    text = re.sub(r'[^\w\s]', '', text)
+    sentences = textstat.sentence_count(text)
+    words = textstat.lexicon_count(text)
+    return words / sentences if sentences > 0 else 0
+
+# Function run in the worker processes: readability, sentiment and sentence complexity of one text
+def score_text(text):
+    flesch_reading_ease, flesch_kincaid_grade = analyze_text_complexity(text)
+    return flesch_reading_ease, flesch_kincaid_grade, get_sentiment(text), analyze_sentence_structure(text)
+
+# Function to score many texts across a process pool (workers=0 scores in this process).
+# Returns an (N, 4) array of Flesch reading ease, Flesch-Kincaid grade, sentiment and words per sentence.
+def score_texts(texts, workers=None, chunksize=32):
+    if workers == 0 or len(texts) < 2 * chunksize:
+        scores = list(map(score_text, texts))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            scores = list(executor.map(score_text, texts, chunksize=chunksize))
+    return np.array(scores, dtype=float).reshape(len(texts), 4)
+
+# Function to pick the n highest-scoring terms of every row of a sparse TF-IDF matrix.
+# Ties are broken by vocabulary order; rows with fewer than n terms return fewer keywords.
+def top_terms(tfidf_matrix, feature_names, n=5):
+    tfidf_matrix = tfidf_matrix.tocsr()
+    row_ids = np.repeat(np.arange(tfidf_matrix.shape[0]), np.diff(tfidf_matrix.indptr))
+    # Sort all stored entries by row, then by descending score, then by term index
+    order = np.lexsort((tfidf_matrix.indices, -tfidf_matrix.data, row_ids))
+    rank = np.arange(len(order)) - tfidf_matrix.indptr[row_ids[order]]
+    keep = order[rank < n]
+    terms = feature_names[tfidf_matrix.indices[keep]]
+    bounds = np.searchsorted(row_ids[keep], np.arange(tfidf_matrix.shape[0] + 1))
+    return [terms[bounds[i]:bounds[i + 1]].tolist() for i in range(tfidf_matrix.shape[0])]
+
+# Function to fit one TF-IDF over the whole corpus and return the top-n keywords of each text
+def get_important_keywords(texts, n=5):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    vectorizer = TfidfVectorizer()
+    tfidf_matrix = vectorizer.fit_transform(texts)
+    return top_terms(tfidf_matrix, vectorizer.get_feature_names_out(), n)
+
+# Function to hash the three texts of a report, so a changed original, detailed finding or analysis is rescored
+def report_hash(original_text, detailed_text, keywords_text):
+    return hashlib.sha256('\0'.join((original_text, detailed_text, keywords_text)).encode('utf-8')).hexdigest()
+
+# Persistent table of the per-report scores, keyed by file name and report hash.
+# metrics.parquet holds the table as of the last save(); rows scored since are appended to
+# updates.jsonl first, so an interrupted run keeps its work. save() folds the log into the table.
+class MetricsCache:
+    def __init__(self, root):
+        os.makedirs(root, exist_ok=True)
+        self.table_path = os.path.join(root, "metrics.parquet")
+        self.log_path = os.path.join(root, "updates.jsonl")
+        self.rows = {}
+
+        if os.path.exists(self.table_path):
+            table = pd.read_parquet(self.table_path)
+            for row in table.to_dict('records'):
+                self.rows[(row['File'], row['Hash'])] = [row[column] for column in SCORE_COLUMNS]
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r', encoding='utf-8') as log_file:
+                for line in log_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # A line cut short by a crash
+                    self.rows[(entry['File'], entry['Hash'])] = entry['Scores']
+
+    # Cached scores of a report, or None
+    def get(self, file, report_hash):
+        return self.rows.get((file, report_hash))
+
+    # Record the scores of newly scored reports
+    def put_many(self, files, hashes, scores):
+        with open(self.log_path, 'a', encoding='utf-8') as log_file:
+            for file, report_hash, row in zip(files, hashes, scores):
+                self.rows[(file, report_hash)] = [float(value) for value in row]
+                log_file.write(json.dumps({'File': file, 'Hash': report_hash, 'Scores': self.rows[(file, report_hash)]}) + "\n")
+
+    # Rewrite metrics.parquet with every row and empty the update log
+    def save(self):
+        keys = sorted(self.rows)
+        table = pd.DataFrame([self.rows[key] for key in keys], columns=SCORE_COLUMNS)
+        table.insert(0, 'File', [file for file, _ in keys])
+        table.insert(1, 'Hash', [report_hash for _, report_hash in keys])
+        table.to_parquet(self.table_path + ".tmp", index=False)
+        os.replace(self.table_path + ".tmp", self.table_path)
+        open(self.log_path, 'w').close()
+
+# Function to assemble the metrics DataFrame of one model from its texts and (N, 8) text scores
+def build_metrics_frame(files, original_texts, detailed_texts, keywords_texts, scores):
+    df = pd.DataFrame({
+        'File': files,
+        'Original Text': original_texts,
+        'Detailed Text': detailed_texts,
+    })
+    count = len(df)
+
+    # Keywords and similarity rating from the CPMK-E analysis
+    keywords = pd.Series(keywords_texts, dtype=object)
+    df['Original Keywords'] = keywords.map(extract_keywords)
+    df['Detailed Keywords'] = keywords.map(extract_keywords)
+    df['Similarity Score'] = pd.to_numeric(keywords.str.extract(r'Similarity Rating: (\d+)', expand=False))
+    df['Keyword Overlap'] = [analyze_keyword_overlap(o, d) for o, d in zip(df['Original Keywords'], df['Detailed Keywords'])]
+
+    for column, values in zip(SCORE_COLUMNS, np.asarray(scores).reshape(count, len(SCORE_COLUMNS)).T):
+        df[column] = values
+
+    # Keywords from a single TF-IDF fitted over originals and detailed findings together
+    important_keywords = get_important_keywords(list(original_texts) + list(detailed_texts)) if count else []
+    df['Original Important Keywords'] = important_keywords[:count]
+    df['Detailed Important Keywords'] = important_keywords[count:]
+
+    df['Complexity Difference'] = df['Detailed Flesch Reading Ease'] - df['Original Flesch Reading Ease']
+
+    # Information Retention Score: grade ratio capped at 1 (1 when the original grade is not positive)
+    original_grade = df['Original Flesch-Kincaid Grade'].to_numpy()
+    detailed_grade = df['Detailed Flesch-Kincaid Grade'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['Info Retention Score'] = np.where(original_grade > 0, np.minimum(detailed_grade / original_grade, 1), 1)
+
+    df['Original Medical Entities'] = df['Original Text'].map(extract_medical_entities)
+    df['Detailed Medical Entities'] = df['Detailed Text'].map(extract_medical_entities)
+    return df
+
+# Function to compute the metrics of several models' outputs as one DataFrame per model.
+# runs maps a model name to aligned (files, original_texts, detailed_texts, keywords_texts) lists.
+# Every distinct text that is not cached is scored once in a single pool, so the originals
+# shared by all models are scored only once and the models are scored in parallel.
+def compute_metrics_many(runs, workers=None, cache=None):
+    hashes, cached_scores, pending = {}, {}, {}
+    for name, (files, original_texts, detailed_texts, keywords_texts) in runs.items():
+        hashes[name] = [report_hash(*texts) for texts in zip(original_texts, detailed_texts, keywords_texts)] if cache is not None else None
+        cached_scores[name] = [cache.get(file, text_hash) for file, text_hash in zip(files, hashes[name])] if cache is not None else [None] * len(files)
+        for i, cached in enumerate(cached_scores[name]):
+            if cached is None:
+                pending.setdefault(original_texts[i])
+                pending.setdefault(detailed_texts[i])
+
+    # Score the texts nobody has cached
+    texts = list(pending)
+    text_scores = dict(zip(texts, score_texts(texts, workers))) if texts else {}
+
+    results = {}
+    for name, (files, original_texts, detailed_texts, keywords_texts) in runs.items():
+        scores = np.zeros((len(files), len(SCORE_COLUMNS)))
+        todo = []
+        for i, cached in enumerate(cached_scores[name]):
+            if cached is None:
+                scores[i] = np.concatenate((text_scores[original_texts[i]], text_scores[detailed_texts[i]]))
+                todo.append(i)
+            else:
+                scores[i] = cached
+        if cache is not None and todo:
+            cache.put_many([files[i] for i in todo], [hashes[name][i] for i in todo], scores[todo])
+        results[name] = build_metrics_frame(files, original_texts, detailed_texts, keywords_texts, scores)
+    return results
+
+# Function to compute every per-report metric used by the plots as one columnar DataFrame.
+# Texts are aligned lists; a report without a similarity rating gets NaN. With a MetricsCache
+# only new or changed reports are scored; the corpus-level TF-IDF keywords are always refitted.
+def compute_metrics(files, original_texts, detailed_texts, keywords_texts, workers=None, cache=None):
+    runs = {None: (files, original_texts, detailed_texts, keywords_texts)}
+    return compute_metrics_many(runs, workers, cache)[None]
+
+# Function to summarise a metrics DataFrame into the five report generation performance scores
+def performance_metrics(df):
+    return {
+        'Avg Similarity': df['Similarity Score'].mean() / 10,
+        'Avg Keyword Overlap': df['Keyword Overlap'].mean() / 100,
+        'Readability Improvement': (df['Complexity Difference'].mean() / df['Original Flesch Reading Ease'].mean()) + 0.5,
+        'Consistency': 1 - (df['Complexity Difference'].std() / df['Complexity Difference'].mean()),
+        'Information Retention': df['Info Retention Score'].mean()
+    }
@@ -1,267 +1,337 @@
 import os
-import re
+import sys
+import argparse
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from collections import Counter
-from sklearn.feature_extraction.text import TfidfVectorizer
-import textstat
-from textblob import TextBlob
-from scipy import stats
-import networkx as nx
-from wordcloud import WordCloud
-from matplotlib.gridspec import GridSpec
+from metrics import MetricsCache, compute_metrics_many, performance_metrics, report_hash
+from streaming import CHUNK_SIZE, READING_EASE_EDGES, SENTIMENT_EDGES, aggregate_metrics, stream_metrics
+
+# The shared corpus reader lives next to the pipeline scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'codes'))
+from corpus import Corpus
+
+WORKERS = None  # Scoring processes (None: CPU count, 0: score in this process)
 
 # Function definitions
-def read_file(file_path):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        return file.read().strip()
-
-def extract_keywords(text):
-    match = re.search(r'Keywords: ([\w\s,]+)', text)
-    return [word.strip() for word in match.group(1).split(',')] if match else []
-
-def analyze_keyword_overlap(original_keywords, detailed_keywords):
-    original_set = set(original_keywords)
-    detailed_set = set(detailed_keywords)
-    overlap = original_set.intersection(detailed_set)
-    return len(overlap) / len(original_set) * 100 if original_set else 0
-
-def analyze_text_complexity(text):
-    flesch_reading_ease = textstat.flesch_reading_ease(text)
-    flesch_kincaid_grade = textstat.flesch_kincaid_grade(text)
-    return flesch_reading_ease, flesch_kincaid_grade
-
-def get_important_keywords(text, n=5):
-    vectorizer = TfidfVectorizer()
-    tfidf_matrix = vectorizer.fit_transform([text])
-    feature_names = vectorizer.get_feature_names_out()
-    tfidf_scores = tfidf_matrix.toarray()[0]
-    important_keywords = sorted(zip(feature_names, tfidf_scores), key=lambda x: x[1], reverse=True)[:n]
-    return [keyword for keyword, _ in important_keywords]
-
-def get_sentiment(text):
-    return TextBlob(text).sentiment.polarity
-
-def extract_similarity_score(text):
-    match = re.search(r'Similarity Rating: (\d+)', text)
-    return int(match.group(1)) if match else None
-
-def extract_medical_entities(text):
-    medical_terms = ['cancer', 'tumor', 'lesion', 'fracture', 'inflammation']
-    return [term for term in medical_terms if term in text.lower()]
-
-def analyze_sentence_structure(text):
-    if not isinstance(text, str):
-        return 0
-    text = re.sub(r'[^\w\s]', '', text)
-    sentences = textstat.sentence_count(text)
-    words = textstat.lexicon_count(text)
-    return words / sentences if sentences > 0 else 0
-
-def calculate_info_retention(row):
-    original_grade = row['Original Flesch-Kincaid Grade']
-    detailed_grade = row['Detailed Flesch-Kincaid Grade']
-    return min(detailed_grade / original_grade, 1) if original_grade > 0 else 1
-
-def adjust_list_length(lst, target_length, fill_value=None):
-    if len(lst) < target_length:
-        return lst + [fill_value] * (target_length - len(lst))
-    return lst[:target_length]
-
-def read_file(file_path):
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            return file.read().strip()
-    except FileNotFoundError:
-        print(f"File not found: {file_path}")
+def read_report(corpus, file_name):
+    text = corpus.read(file_name)
+    if text is None:
+        print(f"File not found: {file_name} in {corpus.source}")
         return None
-
-# Main script
-findings_folder = "./findings"
-detailed_findings_folder = "./gemini1.5flash/detailed_findings"
-keywords_folder = "./gemini1.5flash/keywords"
-output_folder = "./analysis_results"
-os.makedirs(output_folder, exist_ok=True)
-
-files = [f for f in os.listdir(findings_folder) if f.endswith('.txt')]
-
-# Data collection
-original_texts, detailed_texts, original_keywords, detailed_keywords = [], [], [], []
-similarity_scores, overlap_percentages = [], []
-original_complexity, detailed_complexity = [], []
-original_important_keywords, detailed_important_keywords = [], []
-original_sentiments, detailed_sentiments = [], []
-
-for file in files:
-    original_path = os.path.join(findings_folder, file)
-    detailed_path = os.path.join(detailed_findings_folder, file)
-    keywords_path = os.path.join(keywords_folder, file)
-
-    original_text = read_file(original_path)
-    detailed_text = read_file(detailed_path)
-    keywords_text = read_file(keywords_path)
-
-    # Skip this file if any of the required texts are missing
-    if original_text is None or detailed_text is None or keywords_text is None:
-        print(f"Skipping file {file} due to missing data")
-        continue
-
-    original_texts.append(original_text)
-    detailed_texts.append(detailed_text)
-
-    orig_keywords = extract_keywords(keywords_text)
-    det_keywords = extract_keywords(keywords_text)
-    original_keywords.append(orig_keywords)
-    detailed_keywords.append(det_keywords)
-
-    similarity_score = extract_similarity_score(keywords_text)
-    if similarity_score is not None:
-        similarity_scores.append(similarity_score)
-
-    overlap_percentages.append(analyze_keyword_overlap(orig_keywords, det_keywords))
-    
-    original_complexity.append(analyze_text_complexity(original_text))
-    detailed_complexity.append(analyze_text_complexity(detailed_text))
-
-    original_important_keywords.append(get_important_keywords(original_text))
-    detailed_important_keywords.append(get_important_keywords(detailed_text))
-
-    original_sentiments.append(get_sentiment(original_text))
-    detailed_sentiments.append(get_sentiment(detailed_text))
-
-# Adjust list lengths
-lengths = {
-    'files': len(files),
-    'original_texts': len(original_texts),
-    'detailed_texts': len(detailed_texts),
-    'original_keywords': len(original_keywords),
-    'detailed_keywords': len(detailed_keywords),
-    'similarity_scores': len(similarity_scores),
-    'overlap_percentages': len(overlap_percentages),
-    'original_complexity': len(original_complexity),
-    'detailed_complexity': len(detailed_complexity),
-    'original_important_keywords': len(original_important_keywords),
-    'detailed_important_keywords': len(detailed_important_keywords),
-    'original_sentiments': len(original_sentiments),
-    'detailed_sentiments': len(detailed_sentiments)
-}
-
-most_common_length = Counter(lengths.values()).most_common(1)[0][0]
-
-files = adjust_list_length(files, most_common_length)
-original_texts = adjust_list_length(original_texts, most_common_length)
-detailed_texts = adjust_list_length(detailed_texts, most_common_length)
-original_keywords = adjust_list_length(original_keywords, most_common_length)
-detailed_keywords = adjust_list_length(detailed_keywords, most_common_length)
-similarity_scores = adjust_list_length(similarity_scores, most_common_length)
-overlap_percentages = adjust_list_length(overlap_percentages, most_common_length)
-original_complexity = adjust_list_length(original_complexity, most_common_length)
-detailed_complexity = adjust_list_length(detailed_complexity, most_common_length)
-original_important_keywords = adjust_list_length(original_important_keywords, most_common_length)
-detailed_important_keywords = adjust_list_length(detailed_important_keywords, most_common_length)
-original_sentiments = adjust_list_length(original_sentiments, most_common_length)
-detailed_sentiments = adjust_list_length(detailed_sentiments, most_common_length)
-
-# Create DataFrame
-df = pd.DataFrame({
-    'File': files,
-    'Original Text': original_texts,
-    'Detailed Text': detailed_texts,
-    'Original Keywords': original_keywords,
-    'Detailed Keywords': detailed_keywords,
-    'Similarity Score': similarity_scores,
-    'Keyword Overlap': overlap_percentages,
-    'Original Complexity': original_complexity,
-    'Detailed Complexity': detailed_complexity,
-    'Original Important Keywords': original_important_keywords,
-    'Detailed Important Keywords': detailed_important_keywords,
-    'Original Sentiment': original_sentiments,
-    'Detailed Sentiment': detailed_sentiments
-})
-
-# Separate complexity scores and calculate differences
-df['Original Flesch Reading Ease'] = df['Original Complexity'].apply(lambda x: x[0])
-df['Original Flesch-Kincaid Grade'] = df['Original Complexity'].apply(lambda x: x[1])
-df['Detailed Flesch Reading Ease'] = df['Detailed Complexity'].apply(lambda x: x[0])
-df['Detailed Flesch-Kincaid Grade'] = df['Detailed Complexity'].apply(lambda x: x[1])
-df['Complexity Difference'] = df['Detailed Flesch Reading Ease'] - df['Original Flesch Reading Ease']
-
-# Calculate Information Retention Score
-df['Info Retention Score'] = df.apply(calculate_info_retention, axis=1)
-
-# Add new columns
-df['Original Medical Entities'] = df['Original Text'].apply(extract_medical_entities)
-df['Detailed Medical Entities'] = df['Detailed Text'].apply(extract_medical_entities)
-df['Original Sentence Complexity'] = df['Original Text'].apply(analyze_sentence_structure)
-df['Detailed Sentence Complexity'] = df['Detailed Text'].apply(analyze_sentence_structure)
-
-# Plotting
-plt.rcParams['font.size'] = 14
-plt.rcParams['axes.labelweight'] = 'bold'
-plt.rcParams['axes.titleweight'] = 'bold'
-plt.rcParams['lines.linewidth'] = 2
-
-fontsize = 18
-fig, axs = plt.subplots(1, 5, figsize=(30, 6))
-
-# 1. Distribution of Complexity Difference
-sns.boxplot(y=df['Complexity Difference'], ax=axs[0])
-axs[0].set_title('Complexity Difference\n(Detailed - Original)', fontsize=fontsize)
-axs[0].set_ylabel('Flesch Reading Ease Difference', fontsize = fontsize)
-axs[0].axhline(y=0, color='r', linestyle='--')
-
-# 2. Sentiment Preservation
-scatter = axs[1].scatter(df['Original Sentiment'], df['Detailed Sentiment'], 
-                         c=df['Similarity Score'], s=df['Keyword Overlap'], cmap='coolwarm', alpha=0.7)
-axs[1].set_title('Sentiment Preservation', fontsize=fontsize)
-axs[1].set_xlabel('Original Sentiment', fontsize = fontsize)
-axs[1].set_ylabel('Detailed Sentiment', fontsize = fontsize)
-axs[1].plot([-1, 1], [-1, 1], 'r--', label='Perfect Preservation')
-plt.colorbar(scatter, ax=axs[1], label='Similarity Score')
-
-# 3. Distribution of Similarity Scores
-sns.histplot(data=df, x='Similarity Score', kde=True, color='lightgreen', bins=10, ax=axs[2])
-axs[2].set_title('Similarity Score Distribution', fontsize=fontsize)
-axs[2].set_xlabel('Similarity Score', fontsize=fontsize)
-axs[2].set_ylabel('Frequency', fontsize=fontsize)
-axs[2].axvline(df['Similarity Score'].mean(), color='red', linestyle='--', label=f'Mean: {df["Similarity Score"].mean():.2f}')
-
-# 4. Text Complexity Comparison
-scatter = axs[3].scatter(df['Original Flesch Reading Ease'], df['Detailed Flesch Reading Ease'], 
-                         c=df['Similarity Score'], s=df['Keyword Overlap'], cmap='viridis', alpha=0.7)
-axs[3].set_title('Text Complexity Comparison', fontsize=fontsize)
-axs[3].set_xlabel('Original Text Complexity', fontsize=fontsize)
-axs[3].set_ylabel('Detailed Text Complexity', fontsize=fontsize)
-axs[3].plot([0, 100], [0, 100], 'r--', label='Equal Complexity')
-plt.colorbar(scatter, ax=axs[3], label='Similarity Score')
-
-# 5. Enhanced Report Generation Performance
-metrics = {
-    'Avg Similarity': df['Similarity Score'].mean() / 10,
-    'Avg Keyword Overlap': df['Keyword Overlap'].mean() / 100,
-    'Readability Improvement': (df['Complexity Difference'].mean() / df['Original Flesch Reading Ease'].mean()) + 0.5,
-    'Consistency': 1 - (df['Complexity Difference'].std() / df['Complexity Difference'].mean()),
-    'Information Retention': df['Info Retention Score'].mean()
-}
-
-categories = list(metrics.keys())
-values = list(metrics.values())
-
-angles = np.linspace(0, 2*np.pi, len(categories), endpoint=False)
-values = np.concatenate((values, [values[0]]))  # Repeat the first value to close the polygon
-angles = np.concatenate((angles, [angles[0]]))  # Repeat the first angle to close the polygon
-
-axs[4] = plt.subplot(155, polar=True)
-axs[4].plot(angles, values)
-axs[4].fill(angles, values, alpha=0.3)
-axs[4].set_xticks(angles[:-1])
-# axs[4].set_xticklabels(categories)
-axs[4].set_title('Enhanced Report\nGeneration Performance', fontsize=fontsize)
-
-plt.tight_layout()
-plt.savefig(os.path.join(output_folder, 'combined_analysis_plots.png'), dpi=600, bbox_inches='tight')
-plt.close()
-
-print("Combined analysis plots saved as 'combined_analysis_plots.png' in the output folder.")
\ No newline at end of file
+    return text.strip()
+
+# Function to locate the detailed_findings and keywords of a model output tree (folder or zip archive)
+def tree_sources(tree):
+    if os.path.isdir(tree):
+        return os.path.join(tree, "detailed_findings"), os.path.join(tree, "keywords")
+    return f"{tree}:detailed_findings", f"{tree}:keywords"
+
+# Function to read the original findings once, as {file name: text}
+def load_originals(findings_source):
+    with Corpus(findings_source) as findings_corpus:
+        return {file: read_report(findings_corpus, file) for file in findings_corpus.names() if file.endswith('.txt')}
+
+# Function to read the aligned original, detailed and keyword texts of every report with all three
+def load_texts(originals, detailed_source, keywords_source):
+    detailed_corpus = Corpus(detailed_source)
+    keywords_corpus = Corpus(keywords_source)
+
+    files, original_texts, detailed_texts, keywords_texts = [], [], [], []
+    for file, original_text in originals.items():
+        detailed_text = read_report(detailed_corpus, file)
+        keywords_text = read_report(keywords_corpus, file)
+
+        # Skip this file if any of the required texts are missing
+        if original_text is None or detailed_text is None or keywords_text is None:
+            print(f"Skipping file {file} due to missing data")
+            continue
+
+        files.append(file)
+        original_texts.append(original_text)
+        detailed_texts.append(detailed_text)
+        keywords_texts.append(keywords_text)
+
+    for corpus in (detailed_corpus, keywords_corpus):
+        corpus.close()
+    return files, original_texts, detailed_texts, keywords_texts
+
+# Function to set the shared figure style
+def set_plot_style():
+    import matplotlib.pyplot as plt
+
+    plt.rcParams['font.size'] = 14
+    plt.rcParams['axes.labelweight'] = 'bold'
+    plt.rcParams['axes.titleweight'] = 'bold'
+    plt.rcParams['lines.linewidth'] = 2
+
+# Function to draw the five analysis panels of one model into a row of axes.
+# row and rows place the polar performance panel in the figure grid; label prefixes the titles.
+def draw_analysis_row(axs, df, row=0, rows=1, label=None):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    fontsize = 18
+    prefix = f"{label}: " if label else ""
+
+    # 1. Distribution of Complexity Difference
+    sns.boxplot(y=df['Complexity Difference'], ax=axs[0])
+    axs[0].set_title(prefix + 'Complexity Difference\n(Detailed - Original)', fontsize=fontsize)
+    axs[0].set_ylabel('Flesch Reading Ease Difference', fontsize = fontsize)
+    axs[0].axhline(y=0, color='r', linestyle='--')
+
+    # 2. Sentiment Preservation
+    scatter = axs[1].scatter(df['Original Sentiment'], df['Detailed Sentiment'], 
+                             c=df['Similarity Score'], s=df['Keyword Overlap'], cmap='coolwarm', alpha=0.7)
+    axs[1].set_title(prefix + 'Sentiment Preservation', fontsize=fontsize)
+    axs[1].set_xlabel('Original Sentiment', fontsize = fontsize)
+    axs[1].set_ylabel('Detailed Sentiment', fontsize = fontsize)
+    axs[1].plot([-1, 1], [-1, 1], 'r--', label='Perfect Preservation')
+    plt.colorbar(scatter, ax=axs[1], label='Similarity Score')
+
+    # 3. Distribution of Similarity Scores
+    sns.histplot(data=df, x='Similarity Score', kde=True, color='lightgreen', bins=10, ax=axs[2])
+    axs[2].set_title(prefix + 'Similarity Score Distribution', fontsize=fontsize)
+    axs[2].set_xlabel('Similarity Score', fontsize=fontsize)
+    axs[2].set_ylabel('Frequency', fontsize=fontsize)
+    axs[2].axvline(df['Similarity Score'].mean(), color='red', linestyle='--', label=f'Mean: {df["Similarity Score"].mean():.2f}')
+
+    # 4. Text Complexity Comparison
+    scatter = axs[3].scatter(df['Original Flesch Reading Ease'], df['Detailed Flesch Reading Ease'], 
+                             c=df['Similarity Score'], s=df['Keyword Overlap'], cmap='viridis', alpha=0.7)
+    axs[3].set_title(prefix + 'Text Complexity Comparison', fontsize=fontsize)
+    axs[3].set_xlabel('Original Text Complexity', fontsize=fontsize)
+    axs[3].set_ylabel('Detailed Text Complexity', fontsize=fontsize)
+    axs[3].plot([0, 100], [0, 100], 'r--', label='Equal Complexity')
+    plt.colorbar(scatter, ax=axs[3], label='Similarity Score')
+
+    # 5. Enhanced Report Generation Performance
+    draw_performance_panel(axs, performance_metrics(df), row, rows, prefix)
+
+# Function to draw the polar report generation performance panel in place of the fifth axes of a row
+def draw_performance_panel(axs, metrics, row=0, rows=1, prefix="", fontsize=18):
+    import matplotlib.pyplot as plt
+
+    categories = list(metrics.keys())
+    values = list(metrics.values())
+
+    angles = np.linspace(0, 2*np.pi, len(categories), endpoint=False)
+    values = np.concatenate((values, [values[0]]))  # Repeat the first value to close the polygon
+    angles = np.concatenate((angles, [angles[0]]))  # Repeat the first angle to close the polygon
+
+    axs[4] = plt.subplot(rows, 5, 5 * row + 5, polar=True)
+    axs[4].plot(angles, values)
+    axs[4].fill(angles, values, alpha=0.3)
+    axs[4].set_xticks(angles[:-1])
+    # axs[4].set_xticklabels(categories)
+    axs[4].set_title(prefix + 'Enhanced Report\nGeneration Performance', fontsize=fontsize)
+
+# Function to draw the five analysis panels of one model from its MetricsAggregate (streaming mode).
+# Scatter plots become 2D bins coloured by mean similarity, and the box plot uses binned quantiles.
+def draw_aggregate_row(axs, aggregate, row=0, rows=1, label=None):
+    import matplotlib.pyplot as plt
+
+    fontsize = 18
+    prefix = f"{label}: " if label else ""
+
+    # 1. Distribution of Complexity Difference
+    q1, median, q3 = (aggregate.complexity_quantile(q) for q in (0.25, 0.5, 0.75))
+    low, high = aggregate.complexity_range
+    axs[0].bxp([{'med': median, 'q1': q1, 'q3': q3, 'whislo': max(low, q1 - 1.5 * (q3 - q1)),
+                 'whishi': min(high, q3 + 1.5 * (q3 - q1)), 'label': ''}], showfliers=False)
+    axs[0].set_title(prefix + 'Complexity Difference\n(Detailed - Original)', fontsize=fontsize)
+    axs[0].set_ylabel('Flesch Reading Ease Difference', fontsize = fontsize)
+    axs[0].axhline(y=0, color='r', linestyle='--')
+
+    # 2. Sentiment Preservation
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_similarity = np.ma.masked_invalid(aggregate.sentiment_similarity / aggregate.sentiment_counts)
+    mesh = axs[1].pcolormesh(SENTIMENT_EDGES, SENTIMENT_EDGES, mean_similarity.T, cmap='coolwarm')
+    axs[1].set_title(prefix + 'Sentiment Preservation', fontsize=fontsize)
+    axs[1].set_xlabel('Original Sentiment', fontsize = fontsize)
+    axs[1].set_ylabel('Detailed Sentiment', fontsize = fontsize)
+    axs[1].plot([-1, 1], [-1, 1], 'r--', label='Perfect Preservation')
+    plt.colorbar(mesh, ax=axs[1], label='Similarity Score')
+
+    # 3. Distribution of Similarity Scores
+    mean = aggregate.mean('Similarity Score')
+    axs[2].bar(np.arange(len(aggregate.similarity_counts)), aggregate.similarity_counts, color='lightgreen')
+    axs[2].set_title(prefix + 'Similarity Score Distribution', fontsize=fontsize)
+    axs[2].set_xlabel('Similarity Score', fontsize=fontsize)
+    axs[2].set_ylabel('Frequency', fontsize=fontsize)
+    axs[2].axvline(mean, color='red', linestyle='--', label=f'Mean: {mean:.2f}')
+
+    # 4. Text Complexity Comparison
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_similarity = np.ma.masked_invalid(aggregate.reading_ease_similarity / aggregate.reading_ease_counts)
+    mesh = axs[3].pcolormesh(READING_EASE_EDGES, READING_EASE_EDGES, mean_similarity.T, cmap='viridis')
+    axs[3].set_title(prefix + 'Text Complexity Comparison', fontsize=fontsize)
+    axs[3].set_xlabel('Original Text Complexity', fontsize=fontsize)
+    axs[3].set_ylabel('Detailed Text Complexity', fontsize=fontsize)
+    axs[3].plot([0, 100], [0, 100], 'r--', label='Equal Complexity')
+    plt.colorbar(mesh, ax=axs[3], label='Similarity Score')
+
+    # 5. Enhanced Report Generation Performance
+    draw_performance_panel(axs, aggregate.performance_metrics(), row, rows, prefix)
+
+
+# Function to draw the five-panel analysis figure from the metrics DataFrame
+def plot_combined_analysis(df, output_path):
+    import matplotlib.pyplot as plt
+
+    set_plot_style()
+    fig, axs = plt.subplots(1, 5, figsize=(30, 6))
+    draw_analysis_row(axs, df)
+
+    plt.tight_layout()
+    plt.savefig(output_path, dpi=600, bbox_inches='tight')
+    plt.close()
+
+# Function to draw the models side by side, one row of five panels per model
+def plot_model_comparison(frames, output_path):
+    import matplotlib.pyplot as plt
+
+    set_plot_style()
+    fig, axs = plt.subplots(len(frames), 5, figsize=(30, 6 * len(frames)), squeeze=False)
+    for row, (name, df) in enumerate(frames.items()):
+        draw_analysis_row(axs[row], df, row, len(frames), name)
+
+    plt.tight_layout()
+    plt.savefig(output_path, dpi=600, bbox_inches='tight')
+    plt.close()
+
+# Function to draw the streaming-mode figure from the models' MetricsAggregates, one row of five panels per model
+def plot_aggregate_analysis(aggregates, output_path):
+    import matplotlib.pyplot as plt
+
+    set_plot_style()
+    fig, axs = plt.subplots(len(aggregates), 5, figsize=(30, 6 * len(aggregates)), squeeze=False)
+    for row, (name, aggregate) in enumerate(aggregates.items()):
+        draw_aggregate_row(axs[row], aggregate, row, len(aggregates), name)
+
+    plt.tight_layout()
+    plt.savefig(output_path, dpi=600, bbox_inches='tight')
+    plt.close()
+
+# Function to summarise each model's metrics in one row
+def summary_table(frames):
+    rows = {}
+    for name, df in frames.items():
+        rows[name] = {
+            'Reports': len(df),
+            'Similarity Score': df['Similarity Score'].mean(),
+            'Keyword Overlap': df['Keyword Overlap'].mean(),
+            'Original Flesch Reading Ease': df['Original Flesch Reading Ease'].mean(),
+            'Detailed Flesch Reading Ease': df['Detailed Flesch Reading Ease'].mean(),
+            'Complexity Difference': df['Complexity Difference'].mean(),
+            'Original Sentiment': df['Original Sentiment'].mean(),
+            'Detailed Sentiment': df['Detailed Sentiment'].mean(),
+            'Info Retention Score': df['Info Retention Score'].mean(),
+            **performance_metrics(df),
+        }
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+# Function to summarise each model's MetricsAggregate in one row, with the columns of summary_table
+def aggregate_summary_table(aggregates):
+    rows = {}
+    for name, aggregate in aggregates.items():
+        rows[name or 'model'] = {
+            'Reports': aggregate.reports,
+            **{column: aggregate.mean(column) for column in aggregate.MEAN_COLUMNS},
+            **aggregate.performance_metrics(),
+        }
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+# Function to run the memory-bounded analysis: the metrics of every model are streamed chunk by chunk
+# into typed Parquet files (metrics[_NAME].parquet), which are then aggregated batch by batch into
+# the arrays the figure and the summary table are drawn from. The metrics cache is not used.
+def run_streaming(models, findings_source, output_folder, chunk_size=CHUNK_SIZE, workers=None):
+    sources = {name: tree_sources(tree) for name, tree in models.items()}
+    paths = stream_metrics(findings_source, sources, output_folder, chunk_size, workers)
+    aggregates = {name: aggregate_metrics(path) for name, path in paths.items()}
+
+    compare = None not in models
+    figure = 'model_comparison_plots.png' if compare else 'combined_analysis_plots.png'
+    table = 'model_comparison.csv' if compare else 'summary.csv'
+    plot_aggregate_analysis(aggregates, os.path.join(output_folder, figure))
+    summary = aggregate_summary_table(aggregates)
+    summary.to_csv(os.path.join(output_folder, table))
+    print(summary.to_string())
+    print(f"Plots and table saved as '{figure}' and '{table}' in the output folder; per-report metrics in "
+          + ", ".join(os.path.basename(path) for path in paths.values()) + ".")
+
+# Function to report how many reports of each model would be analysed and how many are already
+# scored in the metrics cache, without scoring, plotting or writing anything
+def dry_run(runs, cache_root):
+    cache = MetricsCache(cache_root) if os.path.isdir(cache_root) else None
+    for name, (files, original_texts, detailed_texts, keywords_texts) in runs.items():
+        cached = 0
+        if cache is not None:
+            cached = sum(cache.get(file, report_hash(*texts)) is not None
+                         for file, texts in zip(files, zip(original_texts, detailed_texts, keywords_texts)))
+        print(f"{name or 'model'}: {len(files)} reports with all three texts, {cached} already scored, {len(files) - cached} to score")
+
+# Function to parse a --compare NAME=TREE value
+def parse_model(value):
+    name, separator, tree = value.partition('=')
+    if not separator or not name or not tree:
+        raise argparse.ArgumentTypeError(f"Model must look like NAME=TREE, got {value!r}")
+    return name, tree
+
+# Function to parse command-line options
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse and plot detailed findings against the original IU X-Ray findings.")
+    parser.add_argument("--findings", default="./findings.zip", help="Original findings: folder, zip archive or JSONL/Parquet corpus")
+    parser.add_argument("--model-tree", default="./gemini1.5flash.zip",
+                        help="Output tree (folder or zip) with detailed_findings/ and keywords/ to analyse")
+    parser.add_argument("--compare", type=parse_model, action="append", default=None, metavar="NAME=TREE",
+                        help="Compare several output trees side by side (repeat per model)")
+    parser.add_argument("--output-folder", default="./analysis_results", help="Folder for plots, tables and the metrics cache")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Scoring processes (default: CPU count, 0 scores in this process)")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Memory-bounded mode: score the reports in chunks into typed Parquet columns and plot from aggregated arrays")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Reports held in memory at a time in streaming mode")
+    parser.add_argument("--dry-run", action="store_true", help="Check the inputs and report what would be scored, without scoring or plotting")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    output_folder = args.output_folder
+    models = dict(args.compare) if args.compare else {None: args.model_tree}
+    if args.streaming and not args.dry_run:
+        run_streaming(models, args.findings, output_folder, args.chunk_size, args.workers)
+        return
+
+    # Data collection: the originals are read once and shared by every model. Each source is a folder,
+    # a zip archive (archive.zip:subfolder) or a JSONL/Parquet corpus, so the shipped archives are read without extracting them
+    originals = load_originals(args.findings)
+    runs = {name: load_texts(originals, *tree_sources(tree)) for name, tree in models.items()}
+    if args.dry_run:
+        print(f"{len(originals)} original findings in {args.findings}")
+        dry_run(runs, os.path.join(output_folder, "metrics_cache"))
+        return
+
+    os.makedirs(output_folder, exist_ok=True)
+    metrics_cache = MetricsCache(os.path.join(output_folder, "metrics_cache"))
+
+    # Score every new or changed report of every model in one columnar pass
+    frames = compute_metrics_many(runs, workers=args.workers, cache=metrics_cache)
+    metrics_cache.save()
+
+    if not args.compare:
+        plot_combined_analysis(frames[None], os.path.join(output_folder, 'combined_analysis_plots.png'))
+        print("Combined analysis plots saved as 'combined_analysis_plots.png' in the output folder.")
+        return
+
+    plot_model_comparison(frames, os.path.join(output_folder, 'model_comparison_plots.png'))
+    summary = summary_table(frames)
+    summary.to_csv(os.path.join(output_folder, 'model_comparison.csv'))
+    print(summary.to_string())
+    print("Comparison plots and table saved as 'model_comparison_plots.png' and 'model_comparison.csv' in the output folder.")
+
+# Usage (from the eclectic folder):
+#   python plotting.py
+#   python plotting.py --compare gemini=./gemini1.5flash.zip --compare other=./other_model_outputs
+#   python plotting.py --streaming --chunk-size 256
+# The guard keeps the scoring worker processes from re-running the script
+if __name__ == "__main__":
+    main()
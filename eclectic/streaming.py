@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from metrics import (MEDICAL_TERMS, SCORE_COLUMNS, analyze_keyword_overlap, extract_keywords, extract_similarity_score,
+                     score_text, top_terms)
+
+# The shared corpus reader lives next to the pipeline scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'codes'))
+from corpus import Corpus
+
+CHUNK_SIZE = 512  # Reports held in memory at a time
+# Fixed bins of the aggregated arrays the streaming figures are drawn from
+COMPLEXITY_DIFFERENCE_EDGES = np.linspace(-300, 300, 2401)
+SENTIMENT_EDGES = np.linspace(-1, 1, 41)
+READING_EASE_EDGES = np.linspace(-100, 150, 51)
+
+# Function to read the reports in chunks of at most chunk_size: yields the file names, original texts and
+# {model: (detailed texts, keywords texts)} of each chunk, with None where a model has no output for a file.
+# Archives are read without memory-mapping, so pages read earlier do not stay in the resident set.
+def iter_report_chunks(findings_source, model_sources, chunk_size=CHUNK_SIZE):
+    findings_corpus = Corpus(findings_source, use_mmap=False)
+    model_corpora = {name: (Corpus(detailed_source, use_mmap=False), Corpus(keywords_source, use_mmap=False))
+                     for name, (detailed_source, keywords_source) in model_sources.items()}
+    try:
+        files = [file for file in findings_corpus.names() if file.endswith('.txt')]
+        for start in range(0, len(files), chunk_size):
+            chunk_files = files[start:start + chunk_size]
+            originals = [findings_corpus.read(file).strip() for file in chunk_files]
+            outputs = {}
+            for name, (detailed_corpus, keywords_corpus) in model_corpora.items():
+                detailed = [detailed_corpus.read(file) for file in chunk_files]
+                keywords = [keywords_corpus.read(file) for file in chunk_files]
+                outputs[name] = ([text.strip() if text is not None else None for text in detailed],
+                                 [text.strip() if text is not None else None for text in keywords])
+            yield chunk_files, originals, outputs
+    finally:
+        findings_corpus.close()
+        for corpora in model_corpora.values():
+            for corpus in corpora:
+                corpus.close()
+
+# Function to list the rows of a chunk a model has all three texts for
+def complete_rows(detailed_texts, keywords_texts):
+    return [i for i, (detailed, keywords) in enumerate(zip(detailed_texts, keywords_texts)) if detailed is not None and keywords is not None]
+
+# Function to count, per model, in how many of its original and detailed texts each term occurs.
+# Returns {model: (sorted vocabulary, idf vector)} with the smoothed idf TfidfVectorizer would fit
+# over the same texts, so keywords match the in-memory analysis.
+def fit_keyword_idf(findings_source, model_sources, chunk_size=CHUNK_SIZE):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    analyzer = TfidfVectorizer().build_analyzer()
+    document_counts = {name: {} for name in model_sources}
+    documents = dict.fromkeys(model_sources, 0)
+    for _, originals, outputs in iter_report_chunks(findings_source, model_sources, chunk_size):
+        for name, (detailed_texts, keywords_texts) in outputs.items():
+            counts = document_counts[name]
+            for i in complete_rows(detailed_texts, keywords_texts):
+                for text in (originals[i], detailed_texts[i]):
+                    for term in set(analyzer(text)):
+                        counts[term] = counts.get(term, 0) + 1
+                documents[name] += 2
+
+    idf = {}
+    for name, counts in document_counts.items():
+        vocabulary = sorted(counts)
+        frequencies = np.array([counts[term] for term in vocabulary], dtype=float)
+        idf[name] = (vocabulary, np.log((1 + documents[name]) / (1 + frequencies)) + 1)
+    return idf
+
+# Function to encode which MEDICAL_TERMS a text mentions as a bitmask
+def medical_entity_mask(text):
+    lowered = text.lower()
+    return sum(1 << bit for bit, term in enumerate(MEDICAL_TERMS) if term in lowered)
+
+# Function to define the typed columns of the streaming metrics file. The keyword vocabulary is stored
+# in the file metadata; keyword columns hold indices into it.
+def metrics_schema(vocabulary):
+    import pyarrow as pa
+
+    fields = [("File", pa.string()), ("Similarity Score", pa.float32()), ("Keyword Overlap", pa.float32())]
+    fields += [(column, pa.float32()) for column in SCORE_COLUMNS]
+    fields += [
+        ("Complexity Difference", pa.float32()),
+        ("Info Retention Score", pa.float32()),
+        ("Original Important Keywords", pa.list_(pa.int32())),
+        ("Detailed Important Keywords", pa.list_(pa.int32())),
+        ("Original Medical Entities", pa.uint8()),
+        ("Detailed Medical Entities", pa.uint8()),
+    ]
+    metadata = {"keyword_vocabulary": json.dumps(vocabulary), "medical_terms": json.dumps(MEDICAL_TERMS)}
+    return pa.schema(fields, metadata=metadata)
+
+# Function to compute the metric columns of one model's rows of a chunk as a record batch
+def metrics_batch(schema, files, original_texts, detailed_texts, keywords_texts, text_scores, vectorizer, idf):
+    import pyarrow as pa
+
+    count = len(files)
+    scores = np.array([np.concatenate((text_scores[original], text_scores[detailed]))
+                       for original, detailed in zip(original_texts, detailed_texts)], dtype=float).reshape(count, len(SCORE_COLUMNS))
+    similarity = np.array([extract_similarity_score(text) for text in keywords_texts], dtype=float)  # None becomes NaN
+    overlap = np.array([analyze_keyword_overlap(extract_keywords(text), extract_keywords(text)) for text in keywords_texts], dtype=float)
+
+    # Same top terms as the corpus-wide TF-IDF: the row normalisation does not change the ranking
+    important_keywords = [[]] * (2 * count)
+    if vectorizer is not None:
+        tfidf_matrix = vectorizer.transform(list(original_texts) + list(detailed_texts)).tocsr().astype(float)
+        tfidf_matrix.data *= idf[tfidf_matrix.indices]
+        important_keywords = top_terms(tfidf_matrix, np.arange(len(idf), dtype=np.int32))
+
+    original_grade, detailed_grade = scores[:, 1], scores[:, 5]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        info_retention = np.where(original_grade > 0, np.minimum(detailed_grade / original_grade, 1), 1)
+
+    columns = [pa.array(files, pa.string()), pa.array(similarity, pa.float32()), pa.array(overlap, pa.float32())]
+    columns += [pa.array(values, pa.float32()) for values in scores.T]
+    columns += [
+        pa.array(scores[:, 4] - scores[:, 0], pa.float32()),
+        pa.array(info_retention, pa.float32()),
+        pa.array(important_keywords[:count], pa.list_(pa.int32())),
+        pa.array(important_keywords[count:], pa.list_(pa.int32())),
+        pa.array([medical_entity_mask(text) for text in original_texts], pa.uint8()),
+        pa.array([medical_entity_mask(text) for text in detailed_texts], pa.uint8()),
+    ]
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+# Function to compute every model's metrics chunk by chunk into one Parquet file per model.
+# Only chunk_size reports are in memory at a time: a first pass fits the keyword idf, a second scores
+# each chunk (texts shared by the models once) in a process pool and appends the typed columns.
+# Returns {model: metrics file path}.
+def stream_metrics(findings_source, model_sources, output_folder, chunk_size=CHUNK_SIZE, workers=None):
+    import pyarrow.parquet as pq
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    idf = fit_keyword_idf(findings_source, model_sources, chunk_size)
+    os.makedirs(output_folder, exist_ok=True)
+    paths, writers, vectorizers, schemas = {}, {}, {}, {}
+    for name in model_sources:
+        vocabulary, _ = idf[name]
+        paths[name] = os.path.join(output_folder, f"metrics_{name}.parquet" if name else "metrics.parquet")
+        schemas[name] = metrics_schema(vocabulary)
+        writers[name] = pq.ParquetWriter(paths[name] + ".tmp", schemas[name])
+        vectorizers[name] = CountVectorizer(vocabulary=vocabulary) if vocabulary else None
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers != 0 else None
+    try:
+        for chunk_files, originals, outputs in iter_report_chunks(findings_source, model_sources, chunk_size):
+            rows = {name: complete_rows(*texts) for name, texts in outputs.items()}
+            for name in outputs:
+                for file in sorted(set(chunk_files) - {chunk_files[i] for i in rows[name]}):
+                    print(f"Skipping file {file} due to missing data")
+
+            # Score every distinct text of the chunk once
+            texts = {}
+            for name, (detailed_texts, _) in outputs.items():
+                for i in rows[name]:
+                    texts.setdefault(originals[i])
+                    texts.setdefault(detailed_texts[i])
+            texts = list(texts)
+            scores = executor.map(score_text, texts, chunksize=32) if executor is not None else map(score_text, texts)
+            text_scores = dict(zip(texts, (np.array(score, dtype=float) for score in scores)))
+
+            for name, (detailed_texts, keywords_texts) in outputs.items():
+                if not rows[name]:
+                    continue
+                writers[name].write_batch(metrics_batch(
+                    schemas[name], [chunk_files[i] for i in rows[name]], [originals[i] for i in rows[name]],
+                    [detailed_texts[i] for i in rows[name]], [keywords_texts[i] for i in rows[name]],
+                    text_scores, vectorizers[name], idf[name][1]))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        for writer in writers.values():
+            writer.close()
+    for path in paths.values():
+        os.replace(path + ".tmp", path)
+    return paths
+
+# Running sums and fixed-bin histograms of one model's metrics: everything the streaming figures and
+# summary need, in memory independent of the number of reports
+class MetricsAggregate:
+    MEAN_COLUMNS = ['Similarity Score', 'Keyword Overlap', 'Original Flesch Reading Ease', 'Detailed Flesch Reading Ease',
+                    'Complexity Difference', 'Original Sentiment', 'Detailed Sentiment', 'Info Retention Score']
+
+    def __init__(self):
+        self.reports = 0
+        self.sums = dict.fromkeys(self.MEAN_COLUMNS, 0.0)
+        self.counts = dict.fromkeys(self.MEAN_COLUMNS, 0)
+        self.complexity_squares = 0.0
+        self.complexity_histogram = np.zeros(len(COMPLEXITY_DIFFERENCE_EDGES) + 1, dtype=np.int64)  # With under/overflow bins
+        self.complexity_range = (np.inf, -np.inf)
+        self.similarity_counts = np.zeros(11, dtype=np.int64)
+        self.sentiment_counts = np.zeros((len(SENTIMENT_EDGES) - 1,) * 2, dtype=np.int64)
+        self.sentiment_similarity = np.zeros_like(self.sentiment_counts, dtype=float)
+        self.reading_ease_counts = np.zeros((len(READING_EASE_EDGES) - 1,) * 2, dtype=np.int64)
+        self.reading_ease_similarity = np.zeros_like(self.reading_ease_counts, dtype=float)
+
+    # Function to bin points into a 2D grid, clipping them into the edge bins
+    @staticmethod
+    def _grid_add(counts, similarity_sums, edges, x, y, similarity):
+        rows = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, len(edges) - 2)
+        cols = np.clip(np.searchsorted(edges, y, side='right') - 1, 0, len(edges) - 2)
+        rated = ~np.isnan(similarity)
+        np.add.at(counts, (rows[rated], cols[rated]), 1)
+        np.add.at(similarity_sums, (rows[rated], cols[rated]), similarity[rated])
+
+    # Add a batch of rows given as {column: float array}
+    def update(self, columns):
+        self.reports += len(columns['Complexity Difference'])
+        for column in self.MEAN_COLUMNS:
+            values = columns[column]
+            valid = ~np.isnan(values)
+            self.sums[column] += float(values[valid].sum())
+            self.counts[column] += int(valid.sum())
+
+        difference = columns['Complexity Difference']
+        self.complexity_squares += float(np.square(difference).sum())
+        self.complexity_histogram += np.bincount(np.searchsorted(COMPLEXITY_DIFFERENCE_EDGES, difference, side='right'),
+                                                 minlength=len(self.complexity_histogram))
+        if len(difference):
+            self.complexity_range = (min(self.complexity_range[0], float(difference.min())), max(self.complexity_range[1], float(difference.max())))
+
+        similarity = columns['Similarity Score']
+        rated = similarity[~np.isnan(similarity)]
+        self.similarity_counts += np.bincount(np.clip(rated, 0, 10).astype(int), minlength=11)
+        self._grid_add(self.sentiment_counts, self.sentiment_similarity, SENTIMENT_EDGES,
+                       columns['Original Sentiment'], columns['Detailed Sentiment'], similarity)
+        self._grid_add(self.reading_ease_counts, self.reading_ease_similarity, READING_EASE_EDGES,
+                       columns['Original Flesch Reading Ease'], columns['Detailed Flesch Reading Ease'], similarity)
+
+    def mean(self, column):
+        return self.sums[column] / self.counts[column] if self.counts[column] else np.nan
+
+    # Sample standard deviation of the complexity difference, as pandas computes it
+    def complexity_std(self):
+        count = self.counts['Complexity Difference']
+        if count < 2:
+            return np.nan
+        mean = self.mean('Complexity Difference')
+        return float(np.sqrt(max(self.complexity_squares - count * mean * mean, 0) / (count - 1)))
+
+    # Quantile of the complexity difference, to the histogram's bin width
+    def complexity_quantile(self, q):
+        cumulative = np.cumsum(self.complexity_histogram)
+        if not cumulative[-1]:
+            return np.nan
+        index = int(np.searchsorted(cumulative, q * cumulative[-1]))
+        if index == 0:
+            return self.complexity_range[0]
+        if index > len(COMPLEXITY_DIFFERENCE_EDGES) - 1:
+            return self.complexity_range[1]
+        return float((COMPLEXITY_DIFFERENCE_EDGES[index - 1] + COMPLEXITY_DIFFERENCE_EDGES[index]) / 2)
+
+    # The five report generation performance scores of metrics.performance_metrics
+    def performance_metrics(self):
+        return {
+            'Avg Similarity': self.mean('Similarity Score') / 10,
+            'Avg Keyword Overlap': self.mean('Keyword Overlap') / 100,
+            'Readability Improvement': (self.mean('Complexity Difference') / self.mean('Original Flesch Reading Ease')) + 0.5,
+            'Consistency': 1 - (self.complexity_std() / self.mean('Complexity Difference')),
+            'Information Retention': self.mean('Info Retention Score')
+        }
+
+# Function to aggregate a streaming metrics file batch by batch
+def aggregate_metrics(path, batch_size=65536):
+    import pyarrow.parquet as pq
+
+    aggregate = MetricsAggregate()
+    columns = MetricsAggregate.MEAN_COLUMNS
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns):
+        aggregate.update({column: batch.column(column).to_numpy(zero_copy_only=False).astype(float) for column in columns})
+    return aggregate
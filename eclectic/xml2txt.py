@@ -1,47 +1,167 @@
 import os
+import io
+import sys
+import json
+import argparse
+import itertools
+import collections
+import tarfile
+import zipfile
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 
+# Function to pull the patient ID and FINDINGS text out of one report.
+# iterparse stops as soon as the FINDINGS section has been read instead of building the whole tree.
 def extract_findings(xml_file):
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-    
-    # Extract patient ID
-    patient_id = root.find('uId').get('id')
-    
-    # Extract findings
-    findings = root.find('.//AbstractText[@Label="FINDINGS"]')
-    if findings is not None and findings.text is not None:
-        return patient_id, findings.text
-    return patient_id, None
-
-def process_xml_files(xml_folder, output_folder):
+    patient_id, findings = None, None
+    depth = 0
+    for event, elem in ET.iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            # Extract patient ID (the uId element directly under the root)
+            if depth == 2 and elem.tag == "uId" and patient_id is None:
+                patient_id = elem.get("id")
+            continue
+        depth -= 1
+
+        # Extract findings
+        if elem.tag == "AbstractText" and elem.get("Label") == "FINDINGS":
+            findings = elem.text
+            if patient_id is not None:
+                break
+    if patient_id is None:
+        raise ValueError("no uId element")
+    return patient_id, findings
+
+# Function to yield (name, raw bytes) for every XML report in a folder, .zip, or .tgz/.tar.gz archive
+def iter_xml_sources(source):
+    if os.path.isdir(source):
+        for filename in sorted(os.listdir(source)):
+            if filename.endswith('.xml'):
+                with open(os.path.join(source, filename), 'rb') as f:
+                    yield filename, f.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for name in sorted(archive.namelist()):
+                if name.endswith('.xml'):
+                    yield os.path.basename(name), archive.read(name)
+    else:
+        # Tar members are read in archive order so a compressed stream is never rewound
+        with tarfile.open(source, 'r:*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith('.xml'):
+                    yield os.path.basename(member.name), archive.extractfile(member).read()
+
+# Function run in the worker processes: parse one report and return (name, patient_id, findings, error)
+def parse_xml_source(item):
+    filename, data = item
+    try:
+        patient_id, findings = extract_findings(io.BytesIO(data))
+        return filename, patient_id, findings, None
+    except Exception as e:
+        return filename, None, None, str(e)
+
+# Function run in the worker processes: parse a chunk of reports
+def parse_xml_chunk(items):
+    return [parse_xml_source(item) for item in items]
+
+# Function to parse every report of a source, in source order, across a process pool (workers=0 parses inline).
+# At most two chunks per worker are in flight, so only their raw bytes are held in memory at a time.
+def iter_findings(source, workers=None, chunksize=64):
+    items = iter_xml_sources(source)
+    if workers == 0:
+        yield from map(parse_xml_source, items)
+        return
+    workers = workers or os.cpu_count() or 1
+    chunks = iter(lambda: list(itertools.islice(items, chunksize)), [])
+    in_flight = collections.deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunks:
+            in_flight.append(executor.submit(parse_xml_chunk, chunk))
+            if len(in_flight) >= 2 * workers:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+# Function to write the findings as a single corpus file (JSONL or Parquet) sorted by patient ID
+def write_corpus(records, output_path, output_format):
+    if output_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pylist(records, schema=pa.schema([("id", pa.string()), ("findings", pa.string()), ("source", pa.string())]))
+        pq.write_table(table, output_path)
+        return
+    with open(output_path, 'w', encoding='utf-8') as corpus_file:
+        for record in records:
+            corpus_file.write(json.dumps(record) + "\n")
+
+# Function to convert the IU X-Ray reports to text. output_format "txt" writes one <patient_id>.txt
+# per report into output; "jsonl" and "parquet" write one corpus file to output instead.
+# A dry run parses every report and prints the counts without writing anything.
+def process_xml_files(xml_source, output, output_format="txt", workers=None, verbose=False, dry_run=False):
     # Create output folder if it doesn't exist
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    
-    # Process each XML file in the folder
-    for filename in os.listdir(xml_folder):
-        if filename.endswith('.xml'):
-            xml_path = os.path.join(xml_folder, filename)
-            try:
-                patient_id, findings = extract_findings(xml_path)
-                
-                # Skip if no findings are available
-                if findings is None:
-                    print(f"Skipped {filename} - No findings available")
-                    continue
-                
-                # Create and write to text file
-                txt_filename = f"{patient_id}.txt"
-                txt_path = os.path.join(output_folder, txt_filename)
-                with open(txt_path, 'w') as txt_file:
+    if not dry_run and output_format == "txt":
+        os.makedirs(output, exist_ok=True)
+    elif not dry_run and os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    records = {}
+    processed = skipped = failed = 0
+    for filename, patient_id, findings, error in iter_findings(xml_source, workers):
+        if error is not None:
+            print(f"Error processing {filename}: {error}")
+            failed += 1
+            continue
+
+        # Skip if no findings are available
+        if findings is None:
+            if verbose:
+                print(f"Skipped {filename} - No findings available")
+            skipped += 1
+            continue
+
+        if output_format == "txt":
+            # Create and write to text file
+            txt_filename = f"{patient_id}.txt"
+            if not dry_run:
+                with open(os.path.join(output, txt_filename), 'w', encoding='utf-8') as txt_file:
                     txt_file.write(findings)
-                
-                print(f"Processed {filename} -> {txt_filename}")
-            except Exception as e:
-                print(f"Error processing {filename}: {str(e)}")
-
-# Usage
-xml_folder = './ecgen-radiology'
-output_folder = './findings'
-process_xml_files(xml_folder, output_folder)
\ No newline at end of file
+        else:
+            # A later report with the same patient ID replaces the earlier one, as with .txt files
+            txt_filename = patient_id
+            records[patient_id] = {"id": patient_id, "findings": findings, "source": filename}
+        if verbose:
+            print(f"Processed {filename} -> {txt_filename}")
+        processed += 1
+
+    if output_format != "txt" and not dry_run:
+        write_corpus([records[patient_id] for patient_id in sorted(records)], output, output_format)
+    print(f"Processed {processed} reports, skipped {skipped} without findings, {failed} errors -> {output}"
+          + (" (dry run, nothing written)" if dry_run else ""))
+
+# Function to parse command-line options
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Extract the FINDINGS of the IU X-Ray (ecgen-radiology) reports.")
+    parser.add_argument("xml_source", nargs="?", default="./ecgen-radiology",
+                        help="Folder of XML reports, or the ecgen-radiology .tgz/.zip archive")
+    parser.add_argument("output", nargs="?", default=None,
+                        help="Output folder for txt, or corpus file for jsonl/parquet (default: ./findings[.jsonl|.parquet])")
+    parser.add_argument("--format", choices=["txt", "jsonl", "parquet"], default="txt", help="One .txt per report, or one corpus file")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: CPU count, 0 parses in this process)")
+    parser.add_argument("--verbose", action="store_true", help="Print a line per report")
+    parser.add_argument("--dry-run", action="store_true", help="Parse every report and print the counts without writing output")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = args.output or ("./findings" if args.format == "txt" else f"./findings.{args.format}")
+    if not os.path.exists(args.xml_source):
+        sys.exit(f"XML source not found: {args.xml_source}")
+    process_xml_files(args.xml_source, output, args.format, args.workers, args.verbose, args.dry_run)
+
+# Usage:
+#   python xml2txt.py ./ecgen-radiology ./findings
+#   python xml2txt.py NLMCXR_reports.tgz findings.jsonl --format jsonl
+if __name__ == "__main__":
+    main()
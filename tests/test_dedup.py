@@ -0,0 +1,21 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "codes"))
+
+from dedup import group_duplicates, normalize_text
+
+
+def test_exact_key_ignores_case_whitespace_and_punctuation():
+    assert normalize_text("Lungs are clear.  Heart size, normal.") == normalize_text("lungs are clear. heart size normal")
+
+
+def test_exact_key_keeps_sentence_boundaries():
+    assert normalize_text("No pneumothorax, effusion.") != normalize_text("No pneumothorax. Effusion.")
+
+
+def test_sentence_boundaries_separate_groups_in_every_mode():
+    files = ["a.txt", "b.txt"]
+    texts = ["No pneumothorax, effusion.", "No pneumothorax. Effusion."]
+    for mode in ("exact", "near"):
+        assert group_duplicates(files, texts, mode)["b.txt"] == ("b.txt", "self")